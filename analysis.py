@@ -18,7 +18,6 @@ import numpy as np
 import pandas as pd
 
 # Feature Engineering
-from statsmodels.stats.outliers_influence import variance_inflation_factor as vif
 
 # Predictive Analytics
 from sklearn.linear_model import LogisticRegression
@@ -41,8 +40,9 @@ plt.rcParams.update({'figure.autolayout': True})
 
 # Load the data
 datafile = Path.joinpath(consts.DATA_PATH, 'final_merged_set_v6.csv')
-df = pd.read_csv(datafile, parse_dates=False)
-df.head()
+
+# Only the header is needed to plan the cleaning - the full file is only parsed on a cache miss
+header = pd.read_csv(datafile, nrows=0).columns
 
 
 # # Data Cleaning & Feature Engineering
@@ -52,29 +52,22 @@ df.head()
 # In[3]:
 
 
-# Instantiate a Dataset class
-dataset = data.Dataset(df, id_col = 'PtID')
-dataset
-
-
-# In[4]:
-
-
-# -------- Perform an initial cleaning of the dataset ----------
-dataset.clean(to_rename = {**consts.RENAMINGS['demographics'], 
-                             **consts.RENAMINGS['medical']}, 
-              to_drop=[col for col in dataset.df.columns if '_Name' in col] + 
-                      ['MemsNum', 'Monitor', 'pre_dx_date'],
-              to_map = consts.CODEBOOK,
-              to_binarize = ['race_other'],
-              onehots_to_reverse = ['race_']
-             )
+# -------- Plan an initial cleaning of the dataset ----------
+to_rename = {**consts.RENAMINGS['demographics'], **consts.RENAMINGS['medical']}
+clean_kwargs = {
+    'to_rename': to_rename,
+    'to_drop': [col for col in header if '_Name' in col] + ['MemsNum', 'Monitor', 'pre_dx_date'],
+    'to_map': consts.CODEBOOK,
+    'to_binarize': ['race_other'],
+    'onehots_to_reverse': ['race_']
+}
 
 ''' Set dtypes on remaining columns
 For now, naively assume we only have numerics, datetimes, or objects
+Columns that get dropped during cleaning are skipped
 '''
 dtypes_dict = {
-    'numeric': [col for col in dataset.df.columns if 'date' not in col.lower()],
+    'numeric': [col for col in [to_rename.get(c, c) for c in header] + ['race'] if 'date' not in col.lower()],
     'datetime': ['DateEnroll'],
     'categorical': list(set(list(consts.CODEBOOK.keys()) + \
                             ['race', 'education', 'birth_country',
@@ -86,7 +79,13 @@ dtypes_dict = {
                        )
     }
 
-dataset.set_dtypes(dtypes_dict)
+
+# In[4]:
+
+
+# Instantiate a Dataset class - cleaned and typed, or loaded straight from the cache on a warm start
+dataset = data.Dataset.load(datafile, id_col='PtID', clean_kwargs=clean_kwargs, dtypes_dict=dtypes_dict,
+                            compact=True)
 dataset.df.head()
 
 
@@ -97,82 +96,18 @@ dataset.df.head()
 # In[5]:
 
 
-rows = []
-# Get a list of all date columns
-date_cols = list(dataset.df.filter(regex='date\d{3}$').columns)
-
-i = 0
-for col in date_cols:
-
-    # Find all the time cols for that date col
-    time_cols = list(dataset.df.filter(
-        regex='MEMS_{date_col}_time\d{{1}}$'.format(date_col=col)).columns)  
-
-    ''' Perform a melt so we get MEMS events stratified by patient
-        Be sure to include the "within range" column as one of the id_vars''' 
-    additional_cols = [
-        {
-            'original': 'MEMS_' + col + '_numtimes',
-            'new': 'num_times_used_today'
-        }
-    ]
-    if i > 0: # The first date won't have an interval or withinrange
-        additional_cols.append(
-            {
-                'original': 'MEMS_' + col + '_interval',
-                'new': 'interval'
-            }
-        )
-        additional_cols.append(
-            {
-                'original': 'MEMS_' + col + '_withinrange',
-                'new': 'withinrange'
-            }
-        )
-    
-    all_id_col = [dataset.id_col, 'DateEnroll', col] + [x['original'] for x in additional_cols]
-    
-    res = dataset.df[all_id_col + time_cols].melt(id_vars = all_id_col)
-    
-    # Tidy up the resulting dataframe
-    res.rename(columns={col: 'date', 'value': 'time', 'variable': 'MEMS_day'}, 
-               inplace=True)
-
-    res['MEMS_day'] =  res['MEMS_day'].apply(lambda x: int(re.sub(r'_time\d*$', '', x.split('MEMS_date')[1])))
-    
-    res.rename(columns={x['original']:x['new'] for x in additional_cols},
-               inplace=True)
+''' Convert the MEMS columns from wide-form to long-form, one row per participant and time slot
+    Duplicates (introduced by how Kristi's original data was structured) are dropped here too'''
+horizons_df = data.melt_mems_events(dataset, start_date_col='DateEnroll')
 
-#     res.drop(columns=['variable'], inplace=True)
-    
-    rows.append(res) # TODO - double check this...getting a weird warning about index alignment
-    i += 1
-
-horizons_df = pd.concat(rows, axis=0)
-
-# Create combined datetime column
-horizons_df['datetime'] = horizons_df.apply(
-    lambda x: features.get_datetime_col(x), axis=1
-)
-horizons_df['datetime'] = pd.to_datetime(horizons_df['datetime'], errors='coerce')
-
-# Fix dtypes
-horizons_df[['withinrange', 'num_times_used_today']] = horizons_df[['withinrange', 'num_times_used_today']].fillna(0).astype(int)
-horizons_df['date'] = pd.to_datetime(horizons_df['date'], errors='coerce')
-horizons_df['interval'] = pd.to_timedelta(horizons_df['interval']) # Handle NaT intervals for first day?
-
-'''Drop rows with an empty date column.
+''' Create combined datetime column, fix dtypes, and drop rows with an empty date column,
+  or that occurred before a subject's enrollment date.
   Do NOT drop empty time columns - may have dates where it is recorded that the patient
   did not use the cap. So, would have a date but no time. Need this info to calculate
   additional stats later
+  (append_events runs new events through the same steps)
 ''' 
-horizons_df.dropna(subset=['date'], inplace=True)
-
-# Drop duplicates - these must have been introduced with the melt and with how Kristi's original data was structured
-horizons_df.drop_duplicates(inplace=True)
-
-# Remove observations that occurred before a subject's enrollment date
-horizons_df = horizons_df.loc[horizons_df['DateEnroll'] < horizons_df['date']]
+horizons_df = data.normalize_events(horizons_df, start_date_col='DateEnroll')
 
 
 # ### Quick Look at Adherence For Whole Study
@@ -277,108 +212,11 @@ horizons_df
 # In[17]:
 
 
-def get_col_mode(x):
-    m = x.mode()
-    
-    if isinstance(m, str):
-        return m
-    else:
-        try:
-            first_mode = m[0]
-            return first_mode
-        except Exception as e:
-            return np.nan
-
-temporal_featuresets = list()
 '''Group by our desired horizon and add standard metrics such as mean, std
+   Every horizon is derived from a single daily rollup of the events
 '''
-
-for horizon in consts.TARGET_HORIZONS:
-    nominal_cols = []
-    groupby_cols = [dataset.id_col, horizon]
-    
-    # Get the total number of events for the given horizon
-    df = horizons_df.groupby(groupby_cols).agg(
-        n_events=('num_times_used_today', 'sum')
-    ).reset_index()
-    
-    
-    if horizon == 'study_day':
-        cols = ['is_weekday', 'day_of_week']
-        df2 = horizons_df[groupby_cols + cols]
-        df = df.merge(df2, on=groupby_cols, how='inner')
-        
-        # Add columns indicating if the MEMS cap was used during a given time(s) of day
-        # Basically a manual one-hot encoding while we're here
-        col = 'time_of_day'
-        df2 = horizons_df.groupby(groupby_cols)[col].value_counts().reset_index(name='count')
-        df2.rename(columns={'level_2': col}, inplace=True)
-        
-        df2 = df2.pivot_table(
-            columns=col, index=['PtID', 'study_day'], values='count'
-        ).reset_index().rename_axis(None, axis=1)
-        
-        df = df.merge(df2, on=groupby_cols, how='inner')
-        for col in consts.TIME_OF_DAY_PROPS['labels']:
-            df[col] = pd.to_numeric(df[col].fillna(0).apply(lambda x: 1 if x > 0 else x))
-        
-        cols = {x: 'time_of_day_' + x for x in consts.TIME_OF_DAY_PROPS['labels']}
-        df.rename(columns=cols,
-                  inplace=True)
-        
-        # Add to list of nominal cols after one-hot encoding
-        nominal_cols += [col for col in cols.values()]
-        
-    else:
-        if horizon == 'study_week':
-            denom = consts.DAYS_IN_WEEK
-        else:
-            denom = consts.DAYS_IN_MONTH
-        
-        # Get standard temporal metrics
-        df2 = features.calc_standard_temporal_metrics(horizons_df, groupby_cols, 'datetime')
-        df = df.merge(df2, on=groupby_cols, how='inner')
-
-        # Calculate avg and standard deviation of number of times used
-        df2 = horizons_df.groupby(groupby_cols + ['study_day'])['num_times_used_today'].max().reset_index()
-        df2 = horizons_df.groupby(groupby_cols).agg(
-            num_daily_events_mean=('num_times_used_today', lambda x: x.sum() / denom)
-        ).reset_index()
-
-        df = df.merge(df2, on=groupby_cols, how='inner')
-
-        # Get most common time of day of event occurence
-        df2 = horizons_df.groupby(groupby_cols).agg(
-            event_time_of_day_mode=('time_of_day', get_col_mode)
-        ).reset_index()
-
-        df = df.merge(df2, on=groupby_cols, how='inner')
-        
-        # Explicitly set dtype so we can later select and one-hot encode
-        df['event_time_of_day_mode'] = df['event_time_of_day_mode'].astype('category') 
-
-    # Calculate adherence rate
-    if 'day' in horizon:
-        df2 = horizons_df.groupby(groupby_cols).agg(
-            adherence_rate=('withinrange', 'max')
-        ).reset_index()
-    else:
-        df2 = horizons_df.groupby(groupby_cols + ['study_day'])['withinrange'].max().reset_index() # Max will be 1 or 0
-        df2 = df2.groupby(groupby_cols).agg(
-            adherence_rate=('withinrange', lambda x: x.sum() / denom)
-        ).reset_index()
-    
-    df = df.merge(df2, on=groupby_cols, how='inner')
-    
-    # Help pandas since it doesn't process datetimes well and introduces duplicate entries on merges
-    df = df.drop_duplicates(subset=groupby_cols)
-    
-    # Create a featureset from the resulting dataframe
-    temporal_featuresets.append(features.Featureset(df=df,
-                                                    name=horizon, #Intentional for now - using horizon as name
-                                                    id_col=dataset.id_col,
-                                                    horizon=horizon,
-                                                    nominal_cols = nominal_cols))
+temporal_featuresets = features.build_temporal_featuresets(horizons_df, consts.TARGET_HORIZONS,
+                                                           id_col=dataset.id_col)
 
 
 # In[18]:
@@ -413,10 +251,8 @@ df.select_dtypes('number').corr()
 # In[22]:
 
 
-df2 = df.select_dtypes('number').drop(columns=['PtID', 'adherence_rate'])
-vif_data = pd.DataFrame()
-vif_data["feature"] = df2.columns
-vif_data["VIF"]  = [vif(df2.values, i) for i in range(len(df2.columns))]
+# All VIFs at once - centered=False gives the same values as statsmodels' variance_inflation_factor
+vif_data = features.vif_table(temporal_featuresets[0], exclude=['adherence_rate'], centered=False)
 vif_data
 
 
@@ -424,10 +260,7 @@ vif_data
 
 
 # Drop a few to see if we improve
-df2 = df.select_dtypes('number').drop(columns=['PtID', 'adherence_rate', 'n_events'])
-vif_data = pd.DataFrame()
-vif_data["feature"] = df2.columns
-vif_data["VIF"]  = [vif(df2.values, i) for i in range(len(df2.columns))]
+vif_data = features.vif_table(temporal_featuresets[0], exclude=['adherence_rate', 'n_events'], centered=False)
 vif_data
 
 # Yep - looks much better
@@ -453,10 +286,7 @@ df.corr()
 # In[26]:
 
 
-df2 = df.select_dtypes('number').drop(columns=['PtID', 'adherence_rate'])
-vif_data = pd.DataFrame()
-vif_data["feature"] = df2.columns
-vif_data["VIF"]  = [vif(df2.values, i) for i in range(len(df2.columns))]
+vif_data = features.vif_table(temporal_featuresets[1], exclude=['adherence_rate'], centered=False)
 vif_data
 
 
@@ -464,10 +294,7 @@ vif_data
 
 
 # Drop n_events, n_daily_events mean, and between event time mean to see if we improve
-df2 = df.select_dtypes('number').drop(columns=['n_events', 'between_event_time_mean', 'num_daily_events_mean', 'PtID', 'adherence_rate'])
-vif_data = pd.DataFrame()
-vif_data["feature"] = df2.columns
-vif_data["VIF"]  = [vif(df2.values, i) for i in range(len(df2.columns))]
+vif_data = features.vif_table(temporal_featuresets[1], exclude=['adherence_rate', 'n_events', 'between_event_time_mean', 'num_daily_events_mean'], centered=False)
 vif_data
 
 # Yep - looks much better
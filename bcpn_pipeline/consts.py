@@ -2,6 +2,7 @@ from pathlib import Path
 import numpy as np
 
 DATA_PATH = Path('data/')
+CACHE_PATH = Path.joinpath(DATA_PATH, 'cache/')
 
 OUTPUT_PATH_PRIMARY = Path('results/washout')
 OUTPUT_PATH_LAGS = Path.joinpath(OUTPUT_PATH_PRIMARY, 'tuned_lags/')
@@ -25,6 +26,20 @@ TIME_OF_DAY_PROPS ={
 # TARGET_HORIZONS = ['study_day', 'study_week', 'study_month']
 TARGET_HORIZONS = ['study_day', 'study_week']
 
+# Column naming scheme of the wide-form MEMS (smart cap) export
+# Each study date gets a date column (e.g. 'date001') and a set of companion columns
+MEMS_DATE_REGEX = r'date(\d{3})$'
+MEMS_TIME_REGEX = r'^MEMS_(date\d{3})_time(\d{1})$'
+
+# Per-date companion columns, keyed by suffix and mapped to their long-form names
+# The first date has no interval or withinrange, since there is no previous date to compare with
+MEMS_DAILY_COLS = {
+    'numtimes': 'num_times_used_today',
+    'interval': 'interval',
+    'withinrange': 'withinrange'
+}
+MEMS_FIRST_DAY_COLS = ['numtimes']
+
 # Threshold under which participants are considered to be nonadherent
 ADHERENCE_THRESHOLD = 0.8
 
@@ -1 +1,4 @@
-from .dataset import *
\ No newline at end of file
+from .dataset import *
+from .events import *
+from .cache import *
+from .store import *
@@ -0,0 +1,93 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+import pandas as pd
+
+# Preferred on-disk format first - Parquet keeps categoricals and datetimes, pickle handles everything else
+CACHE_FORMATS = ['.parquet', '.pkl']
+
+def _canonicalize(obj):
+    ''' Make arguments hashable in a stable way (e.g., lists built from sets have no fixed order) '''
+    if isinstance(obj, dict):
+        return {str(k): _canonicalize(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple, set)):
+        items = [_canonicalize(v) for v in obj]
+        try:
+            return sorted(items)
+        except TypeError:
+            return items
+    return obj
+
+def fingerprint(datafile=None, chunk_size=1 << 20, **params):
+    '''
+        Build a cache key from the contents of a source file plus any arguments used to process it
+
+        Args:
+            datafile: Path to the source file (optional)
+
+            chunk_size: Number of bytes to read from the source file at a time
+
+            params: Arguments that affect the processed output (e.g., clean and dtype arguments)
+
+        Returns:
+            A hex digest string
+    '''
+    h = hashlib.sha1()
+    if datafile is not None:
+        with open(datafile, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                h.update(chunk)
+
+    h.update(json.dumps(_canonicalize(params), sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+def write_frame(df, path):
+    '''
+        Persist a DataFrame to a columnar file, falling back to pickle when the frame can't be
+        stored as Parquet (e.g., object columns with mixed types, or pyarrow isn't installed)
+
+        Args:
+            df: A pandas DataFrame
+            path: Destination path, without a suffix
+
+        Returns:
+            The path of the file that was written
+    '''
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    target = path.with_suffix('.parquet')
+    try:
+        df.to_parquet(target)
+    except (ImportError, ValueError, TypeError) as e:
+        print('Could not write Parquet (%s) - falling back to pickle.' % e)
+        if target.exists():
+            os.remove(target)
+        target = path.with_suffix('.pkl')
+        df.to_pickle(target)
+
+    # Don't leave a stale copy in the other format behind (read_frame would pick it up)
+    for suffix in CACHE_FORMATS:
+        other = path.with_suffix(suffix)
+        if other != target and other.exists():
+            os.remove(other)
+
+    return target
+
+def read_frame(path):
+    '''
+        Load a DataFrame written by write_frame
+
+        Args:
+            path: Path to the file, without a suffix
+
+        Returns:
+            A pandas DataFrame, or None if no file exists for this path
+    '''
+    path = Path(path)
+    for suffix in CACHE_FORMATS:
+        target = path.with_suffix(suffix)
+        if target.exists():
+            return pd.read_parquet(target) if suffix == '.parquet' else pd.read_pickle(target)
+    return None
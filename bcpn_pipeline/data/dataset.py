@@ -1,6 +1,18 @@
 import pandas as pd
 import numpy as np
+import re
 import itertools
+from pathlib import Path
+
+from ..consts import CACHE_PATH, RENAMINGS, CODEBOOK, MEMS_DATE_REGEX, MEMS_TIME_REGEX
+from .cache import fingerprint, read_frame, write_frame
+
+# Part of every cache key - bump whenever clean(), set_dtypes() or compact_dtypes() change their output,
+# so cached frames in the old schema are rebuilt instead of served
+SCHEMA_VERSION = 2
+
+# Raw columns containing any of these substrings are skipped when reading the CSV (e.g., names)
+DROP_PATTERNS = ['_Name']
 
 class Dataset:
     def __init__(self, df, id_col, feature_categories=None):
@@ -14,9 +26,137 @@ class Dataset:
         # Store a dictionary of category, list of column pairs
         self.feature_categories = feature_categories
 
-    def set_dtypes(self, dtypes_dict):
-        ''' Set dtypes on feature columns '''
+    @classmethod
+    def from_csv(cls, datafile, id_col, to_drop=None, drop_patterns=None, to_rename=None,
+                 chunksize=10000, drop_uninformative=True, feature_categories=None):
+        '''
+            Read only the columns we will keep, in chunks, so that peak memory is bounded by
+            the retained columns rather than the full width of the export
+
+            The file is streamed twice: a first pass keeps only per-column statistics (which columns
+            vary, and which hold numbers in some chunks but text in others), and a second pass reads
+            just the kept columns, with those mixed columns read as strings in every chunk - the same
+            dtypes a whole-file read gives.
+
+            Args:
+                datafile: Path to the raw CSV
+
+                id_col: Name of column that stores a participant's unique identifier
+
+                to_drop: List of columns to skip (raw or renamed names)
+
+                drop_patterns: Columns containing any of these substrings are skipped (defaults to DROP_PATTERNS)
+
+                to_rename: Dictionary of raw to new column names (defaults to consts.RENAMINGS)
+
+                chunksize: Number of rows to parse at a time
+
+                drop_uninformative: Whether to skip columns that turn out to be empty or to hold only
+                    one unique value (clean() would drop these anyway)
+
+                feature_categories: Dictionary of category, list of column pairs
+
+            Returns:
+                A Dataset object holding the raw (not yet renamed or cleaned) columns
+        '''
+        header = pd.read_csv(datafile, nrows=0).columns
+        usecols, dtype, numerics = plan_csv_columns(header, id_col, to_drop, drop_patterns, to_rename)
+
+        first_vals = {}
+        varied = set()
+        kinds = {col: set() for col in usecols}
+        for chunk in read_csv_chunks(datafile, usecols, dtype, numerics, chunksize):
+
+            # Dtype each column was inferred as, ignoring chunks where it is empty
+            for col, col_dtype in chunk.dtypes.items():
+                if chunk[col].notna().any():
+                    kinds[col].add('number' if pd.api.types.is_numeric_dtype(col_dtype) and
+                                   not pd.api.types.is_bool_dtype(col_dtype) else str(col_dtype))
+
+            if drop_uninformative:
+                # Track which columns have more than one unique value across all chunks
+                counts = chunk.nunique()
+                varied.update(counts.index[counts > 1])
+                for col in counts.index[counts == 1]:
+                    val = chunk[col].dropna().iloc[0]
+                    if first_vals.setdefault(col, val) != val:
+                        varied.add(col)
+
+        # Columns inferred differently in different chunks are read as strings throughout
+        mixed = [col for col, col_kinds in kinds.items() if len(col_kinds) > 1]
+        dtype.update({col: str for col in mixed})
+
+        keep = [col for col in usecols if not drop_uninformative or col in varied or col == id_col]
+        df = pd.concat(read_csv_chunks(datafile, keep, dtype, [col for col in numerics if col in keep],
+                                       chunksize), ignore_index=True)
+
+        print('Read %d of %d columns.' % (df.shape[1], len(header)))
+        return cls(df, id_col=id_col, feature_categories=feature_categories)
+
+    @classmethod
+    def load(cls, datafile, id_col, clean_kwargs=None, dtypes_dict=None, compact=False,
+             cache_dir=CACHE_PATH, feature_categories=None, drop_patterns=None):
+        '''
+            Load a cleaned, typed dataset - from the cache if this exact file has already been
+            cleaned with these exact arguments, otherwise from the CSV (and then cache it)
+
+            Args:
+                datafile: Path to the raw CSV
+
+                id_col: Name of column that stores a participant's unique identifier
+
+                clean_kwargs: Dictionary of keyword arguments for clean()
+
+                dtypes_dict: Dictionary passed to set_dtypes()
+
+                compact: Whether to shrink columns to their smallest safe dtypes (see compact_dtypes)
+
+                cache_dir: Directory holding the cached frames (None disables the cache)
+
+                feature_categories: Dictionary of category, list of column pairs
+
+                drop_patterns: Raw columns containing any of these substrings are skipped (defaults to DROP_PATTERNS)
+
+            Returns:
+                A Dataset object
+        '''
+        # Resolve the default first, so the patterns actually used are part of the cache key
+        drop_patterns = list(DROP_PATTERNS if drop_patterns is None else drop_patterns)
+
+        cache_file = None
+        if cache_dir is not None:
+            key = fingerprint(datafile, id_col=id_col, clean_kwargs=clean_kwargs, dtypes_dict=dtypes_dict,
+                              compact=compact, drop_patterns=drop_patterns, schema_version=SCHEMA_VERSION)
+            cache_file = Path(cache_dir) / f'{Path(datafile).stem}_{key}'
+
+            df = read_frame(cache_file)
+            if df is not None:
+                print('Loaded cleaned dataset from cache.')
+                return cls(df, id_col=id_col, feature_categories=feature_categories)
+
+        clean_kwargs = clean_kwargs or {}
+        dataset = cls.from_csv(datafile, id_col=id_col, to_drop=clean_kwargs.get('to_drop'),
+                               drop_patterns=drop_patterns, to_rename=clean_kwargs.get('to_rename'),
+                               feature_categories=feature_categories)
+        if clean_kwargs:
+            dataset.clean(**clean_kwargs)
+        if dtypes_dict or compact:
+            dataset.set_dtypes(dtypes_dict or {}, compact=compact)
+
+        if cache_file is not None:
+            write_frame(dataset.df, cache_file)
+        return dataset
+
+    def set_dtypes(self, dtypes_dict, compact=False):
+        ''' Set dtypes on feature columns 
+            If compact, also shrink every column to its smallest safe dtype and return
+            a per-column memory report (see compact_dtypes)
+        '''
         for dtype, cols in dtypes_dict.items():
+
+            # Skip columns that were dropped during cleaning
+            cols = [col for col in cols if col in self.df.columns]
+
             if dtype == 'datetime':
                 for col in cols:
                     self.df[col] = pd.to_datetime(self.df[col], errors='coerce')
@@ -31,6 +171,10 @@ class Dataset:
             else:
                 for col in cols:
                     self.df[col] = self.df[col].astype(dtype, errors='ignore') 
+
+        if compact:
+            self.df, report = compact_dtypes(self.df)
+            return report
     
     def clean(self, to_rename=None, to_drop=None, to_map = None, to_binarize=None, onehots_to_reverse=None):
         ''' Clean the dataset - E.g., rename columns, eliminate useless columns
@@ -41,32 +185,25 @@ class Dataset:
         if to_rename:
             self.df.rename(columns=to_rename, inplace=True)
 
-        # Drop specific cols
+        # Drop specific cols (some may never have been read - see from_csv)
         # Need to add a safeguard so you can't drop ID columns!
         if to_drop:
-            self.df.drop(columns=to_drop, inplace=True)
+            self.df.drop(columns=to_drop, inplace=True, errors='ignore')
             
-        # Replace all-whitespace cells with NaNs
-        self.df.replace(['^\s+$'], np.nan, regex = True, inplace=True)
+        # Replace all-whitespace cells with NaNs (only object columns can hold strings)
+        null_whitespace(self.df)
 
         # Remove all columns that are completely empty
         self.df.dropna(axis=1, how='all', inplace=True)
 
-        # Get number of unique values for each column
-        counts = self.df.nunique()
-
-        # Record additional columns to drop (those with only one unique value
-        to_del = [i for i,v in enumerate(counts) if v == 1]
-
-        # Drop useless columns
-        self.df.drop(self.df.columns[to_del], axis=1, inplace=True)
-#         print(self.df.shape)
+        # Drop useless columns (those with only one unique value)
+        self.df.drop(columns=single_valued_cols(self.df), inplace=True)
 
         if to_map: # Numeric to strings     
             ''' Convert category numbers to labels, so we can have
             meaningful column names later on'''
             for col in list(to_map.keys()):
-                self.df[col] = pd.to_numeric(self.df[col]).map(to_map[col])
+                self.df[col] = map_codes(self.df[col], to_map[col])
 
         if to_binarize:
             for col in to_binarize:
@@ -74,21 +211,72 @@ class Dataset:
                     
                     ''' Handle the special case of columns that were recoded as strings but
                     need to be binary (1 or 0)''' 
-                    self.df[col] = self.df[col].apply(lambda x: binarize_col(x))    
+                    self.df[col] = binarize_series(self.df[col])
                     
         if onehots_to_reverse:
             for prefix in onehots_to_reverse:
                 cols = [col for col in self.df.columns if prefix in col]
-                self.df[prefix.rstrip('_')] = self.df[cols].apply(
-                    pd.to_numeric, errors='coerce'
-                ).idxmax(1).apply(
-                    # Tried lstrip, but it strips the leading letter for some categories!
-                    lambda x: x.replace(prefix, '') if type(x) == type('string') else x # Guards against NaNs
-                ) 
+                self.df[prefix.rstrip('_')] = reverse_onehot(self.df, cols, prefix)
                 self.df.drop(columns=cols, inplace=True)
                 
         print('Cleaning complete.')
 
+def read_csv_chunks(datafile, usecols, dtype, numerics, chunksize):
+    ''' Stream the selected columns of a CSV, converting codebook columns to numbers chunk by chunk '''
+    for chunk in pd.read_csv(datafile, usecols=usecols, dtype=dtype, chunksize=chunksize,
+                             parse_dates=False):
+
+        # Codes are read as strings so all-whitespace cells can be nulled before converting
+        for col in numerics:
+            chunk[col] = pd.to_numeric(
+                chunk[col].where(~chunk[col].str.fullmatch(r'\s+', na=False))
+            )
+        yield chunk
+
+def plan_csv_columns(header, id_col, to_drop=None, drop_patterns=None, to_rename=None):
+    '''
+        Plan which columns to read, and as which dtypes, from the CSV header alone
+
+        Args:
+            header: List of column names in the raw CSV
+
+            id_col: Name of column that stores a participant's unique identifier (never skipped)
+
+            to_drop: List of columns to skip (raw or renamed names)
+
+            drop_patterns: Columns containing any of these substrings are skipped (defaults to DROP_PATTERNS)
+
+            to_rename: Dictionary of raw to new column names (defaults to consts.RENAMINGS)
+
+        Returns:
+            A tuple of (usecols, dtype dictionary for read_csv, list of columns to convert to numeric)
+    '''
+    if to_rename is None:
+        to_rename = {**RENAMINGS['demographics'], **RENAMINGS['medical']}
+    if drop_patterns is None:
+        drop_patterns = DROP_PATTERNS
+    to_drop = set(to_drop or [])
+
+    usecols = [col for col in header if col == id_col or (
+        col not in to_drop and to_rename.get(col, col) not in to_drop
+        and not any(pattern in col for pattern in drop_patterns)
+    )]
+
+    dtype = {}
+    numerics = []
+    for col in usecols:
+        # MEMS dates, times and intervals stay as strings - they are parsed after reshaping
+        if re.search(MEMS_DATE_REGEX, col) or re.match(MEMS_TIME_REGEX, col) or \
+                (col.startswith('MEMS_') and col.endswith('_interval')):
+            dtype[col] = str
+
+        # Codebook columns hold numeric codes, mapped to labels during cleaning
+        elif to_rename.get(col, col) in CODEBOOK:
+            dtype[col] = str
+            numerics.append(col)
+
+    return usecols, dtype, numerics
+
 def build_df_from_feature_categories(df, feat_categories, id_col):
     # Note - will fail if col(s) not in df
     return df[[id_col] + list(itertools.chain(*[v for k,v in feat_categories.items()]))]
@@ -103,6 +291,150 @@ def __repr__(self):
         f'Number of candidate features: { n_cand_feats }'
     ])
 
+def null_whitespace(df):
+    ''' Replace all-whitespace cells with NaNs, in place '''
+    for col in df.select_dtypes(['object', 'string']).columns:
+        if pd.api.types.infer_dtype(df[col], skipna=True) == 'string':
+            mask = df[col].str.fullmatch(r'\s+', na=False)
+        else:
+            # Object columns can also hold numbers or bools, which the .str accessor rejects
+            mask = df[col].map(lambda x: isinstance(x, str) and x.isspace()).astype(bool)
+        if mask.any():
+            df[col] = df[col].mask(mask)
+    return df
+
+def single_valued_cols(df):
+    ''' Find columns with exactly one unique (non-null) value '''
+    numerics = df.select_dtypes('number')
+
+    # For numerics, min == max is enough - no need to hash every value
+    cols = list(numerics.columns[(numerics.min() == numerics.max()).to_numpy()])
+
+    others = df.drop(columns=numerics.columns)
+    counts = others.nunique()
+    cols += list(counts.index[counts == 1])
+
+    # Keep the original column order
+    return [col for col in df.columns if col in set(cols)]
+
+def map_codes(s, codebook):
+    '''
+        Convert numeric codes to labels, directly as a Categorical
+
+        Args:
+            s: A pandas Series of numeric codes (or strings that parse as numbers)
+            codebook: Dictionary of code, label pairs
+
+        Returns:
+            A categorical Series. Categories are the observed labels, sorted - the same
+            categories we'd get from setting a categorical dtype on the mapped labels.
+    '''
+    labels = np.array(list(codebook.values()), dtype=object)
+    pos = pd.Index(list(codebook.keys())).get_indexer(pd.to_numeric(s))
+
+    # Recode codebook positions into positions within the sorted, observed labels
+    observed = np.unique(pos[pos >= 0])
+    order = observed[np.argsort(labels[observed], kind='stable')]
+    lookup = np.full(len(labels) + 1, -1)
+    lookup[order] = np.arange(len(order))
+
+    # Unmapped codes and NaNs have pos -1, which lands on the trailing -1 in the lookup
+    codes = lookup[pos]
+    return pd.Series(pd.Categorical.from_codes(codes, categories=labels[order]), index=s.index, name=s.name)
+
+def binarize_series(s):
+    ''' Vectorized binarize_col - anything that can't be read as a number is data, coded as 1 '''
+    if s.dtype != object and not pd.api.types.is_string_dtype(s):
+        return s
+
+    floatable = s.isna() | pd.to_numeric(s, errors='coerce').notna() | \
+        s.astype(str).str.strip().str.lower().str.lstrip('+-').isin(['nan', 'inf', 'infinity'])
+    return s.where(floatable, 1)
+
+def reverse_onehot(df, cols, prefix):
+    ''' Collapse one-hot columns into a single column holding the name of the max column (prefix removed) '''
+    values = np.column_stack([pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=float) for col in cols])
+    missing = np.isnan(values).all(axis=1)
+
+    # First max in each row, ignoring NaNs - same as idxmax
+    idx = np.where(np.isnan(values), -np.inf, values).argmax(axis=1)
+
+    # Tried lstrip, but it strips the leading letter for some categories!
+    names = np.array([col.replace(prefix, '') for col in cols], dtype=object)
+    res = names[idx]
+    res[missing] = np.nan
+    return pd.Series(res, index=df.index)
+
+def compact_column(s, max_categories=255, category_ratio=0.5):
+    ''' Shrink a single column to the smallest dtype that holds its values exactly '''
+    if pd.api.types.is_bool_dtype(s) or isinstance(s.dtype, pd.CategoricalDtype):
+        return s
+
+    if pd.api.types.is_integer_dtype(s):
+        return pd.to_numeric(s, downcast='integer')
+
+    if pd.api.types.is_float_dtype(s):
+        values = s.to_numpy()
+        missing = np.isnan(values)
+
+        present = values[~missing]
+        if len(present) and np.array_equal(present, np.round(present)):
+
+            # Integer-valued floats (e.g., flags and counts) without gaps can become ints
+            if not missing.any():
+                return pd.to_numeric(s, downcast='integer')
+
+            # With gaps (e.g., YN flags that weren't always answered), a nullable integer -
+            # its values plus a 1-byte mask - is still smaller than float32, if it fits in 16 bits
+            for dtype in ['Int8', 'Int16']:
+                info = np.iinfo(dtype.lower())
+                if info.min <= present.min() and present.max() <= info.max:
+                    return s.astype(dtype)
+
+        # Otherwise, float32 only if nothing is lost
+        as_float32 = values.astype(np.float32)
+        if np.array_equal(as_float32.astype(values.dtype), values, equal_nan=True):
+            return s.astype(np.float32)
+        return s
+
+    if pd.api.types.is_string_dtype(s.dtype) and pd.api.types.infer_dtype(s, skipna=True) == 'string':
+        n_unique = s.nunique()
+        if n_unique <= max_categories and n_unique <= category_ratio * len(s):
+            return s.astype('category')
+
+    return s
+
+def compact_dtypes(df, max_categories=255, category_ratio=0.5):
+    '''
+        Downcast numerics to the smallest safe width and turn low-cardinality string columns
+        into categoricals
+
+        Args:
+            df: A pandas DataFrame
+
+            max_categories: String columns with more unique values than this are left alone
+
+            category_ratio: String columns are only converted if unique values / rows is at most this
+
+        Returns:
+            A tuple of (compacted DataFrame, DataFrame reporting dtypes and bytes before and after, per column)
+    '''
+    before = df.memory_usage(deep=True, index=False)
+    dtypes_before = df.dtypes
+
+    df = pd.DataFrame({col: compact_column(df[col], max_categories, category_ratio) for col in df.columns},
+                      index=df.index)
+    after = df.memory_usage(deep=True, index=False)
+
+    report = pd.DataFrame({
+        'dtype_before': dtypes_before.astype(str),
+        'dtype_after': df.dtypes.astype(str),
+        'bytes_before': before,
+        'bytes_after': after
+    })
+    print('Compacted dtypes: %.1f MB -> %.1f MB.' % (before.sum() / 1e6, after.sum() / 1e6))
+    return df, report
+
 def binarize_col(x):
     try:
         ''' try casting to int - if the column has mixed strings and numbers, this will fail for both
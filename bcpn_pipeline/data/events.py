@@ -0,0 +1,260 @@
+import re
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from ..consts import MEMS_DATE_REGEX, MEMS_TIME_REGEX, MEMS_DAILY_COLS, MEMS_FIRST_DAY_COLS, TIME_OF_DAY_PROPS
+
+def parse_mems_schema(columns):
+    '''
+        Parse the wide-form MEMS column names once, so we can reshape without any per-column regex work
+
+        Args:
+            columns: Iterable of column names from the wide-form dataset
+
+        Returns:
+            A list of dicts (one per time column, in melt order), each with the time column,
+            the date column it belongs to, the integer MEMS day, and the companion columns
+            (numtimes, interval, withinrange) for that date - None if a companion doesn't apply
+    '''
+    columns = list(columns)
+    date_cols = [col for col in columns if re.search(MEMS_DATE_REGEX, col)]
+
+    # Group the time columns by the date column they belong to
+    time_cols = {}
+    for col in columns:
+        match = re.match(MEMS_TIME_REGEX, col)
+        if match:
+            time_cols.setdefault(match.group(1), []).append(col)
+
+    schema = []
+    for i, date_col in enumerate(date_cols):
+        mems_day = int(re.search(MEMS_DATE_REGEX, date_col).group(1))
+
+        # The first date won't have an interval or withinrange
+        suffixes = MEMS_FIRST_DAY_COLS if i == 0 else list(MEMS_DAILY_COLS.keys())
+        companions = {
+            new: ('MEMS_' + date_col + '_' + suffix if suffix in suffixes else None)
+            for suffix, new in MEMS_DAILY_COLS.items()
+        }
+
+        for time_col in time_cols.get(date_col, []):
+            schema.append({'date_col': date_col, 'time_col': time_col,
+                           'MEMS_day': mems_day, 'companions': companions})
+    return schema
+
+def _stack(df, cols):
+    ''' Stack the given columns (None for a missing column) into one long array, column by column '''
+    present = [col for col in dict.fromkeys(cols) if col is not None]
+    if not present:
+        return np.full(len(df) * len(cols), np.nan)
+
+    values = df[present].to_numpy()
+    pos = {col: i for i, col in enumerate(present)}
+
+    if any(col is None for col in cols):
+        # Add a trailing all-NaN column for the companions that don't exist
+        values = np.column_stack([values, np.full(len(df), np.nan)])
+        pos[None] = len(present)
+
+    # Transpose so the result is ordered by column, then by row (same as melt)
+    return values[:, [pos[col] for col in cols]].T.ravel()
+
+def drop_duplicate_events(events, subset=None):
+    ''' Drop duplicate rows, using a single 64-bit hash per row as the key '''
+    cols = subset if subset else events.columns
+    hashes = pd.util.hash_pandas_object(events[cols], index=False)
+    return events.loc[~hashes.duplicated().to_numpy()].reset_index(drop=True)
+
+def melt_mems_events(dataset, start_date_col='DateEnroll', dedupe=True):
+    '''
+        Convert the wide-form MEMS columns of a dataset into a long-form event table,
+        with one row per participant and MEMS time slot.
+
+        Args:
+            dataset: A Dataset object whose df holds the wide-form MEMS columns
+
+            start_date_col: Name of column that stores a participant's study start date
+
+            dedupe: Whether to drop duplicate events (introduced by how the original data was structured)
+
+        Returns:
+            A pandas DataFrame with columns id_col, start_date_col, date, num_times_used_today,
+            MEMS_day, time, interval and withinrange
+    '''
+    df = dataset.df
+    schema = parse_mems_schema(df.columns)
+    n_slots = len(schema)
+
+    events = pd.DataFrame({
+        dataset.id_col: np.tile(df[dataset.id_col].to_numpy(), n_slots),
+        start_date_col: np.tile(df[start_date_col].to_numpy(), n_slots),
+        'date': _stack(df, [slot['date_col'] for slot in schema]),
+        'num_times_used_today': _stack(df, [slot['companions']['num_times_used_today'] for slot in schema]),
+        'MEMS_day': np.repeat(np.array([slot['MEMS_day'] for slot in schema], dtype=np.int16), len(df)),
+        'time': _stack(df, [slot['time_col'] for slot in schema]),
+        'interval': _stack(df, [slot['companions']['interval'] for slot in schema]),
+        'withinrange': _stack(df, [slot['companions']['withinrange'] for slot in schema])
+    })
+
+    if dedupe:
+        events = drop_duplicate_events(events)
+
+    return events
+
+def normalize_events(events, start_date_col='DateEnroll', date_col='date', time_col='time'):
+    '''
+        Parse and filter a raw long-form event table (e.g., from melt_mems_events) for analysis
+
+        Args:
+            events: A long-form event table
+
+            start_date_col: Name of column that stores a participant's study start date
+
+            date_col: Name of column that stores the event date
+
+            time_col: Name of column that stores the event time
+
+        Returns:
+            A copy with a combined datetime column, integer usage columns, parsed dates and intervals,
+            and only the dated events after each participant's enrollment. Rows without a time are
+            kept - they record days on which the cap wasn't used.
+    '''
+    from ..features.extract import build_datetime_col
+
+    events = events.copy()
+    events['datetime'], _ = build_datetime_col(events, date_col, time_col)
+
+    events[['withinrange', 'num_times_used_today']] = events[['withinrange', 'num_times_used_today']].fillna(0).astype(int)
+    events[start_date_col] = pd.to_datetime(events[start_date_col], errors='coerce')
+    events[date_col] = pd.to_datetime(events[date_col], errors='coerce')
+    events['interval'] = pd.to_timedelta(events['interval'])
+
+    events = events.dropna(subset=[date_col])
+    return events.loc[events[start_date_col] < events[date_col]]
+
+def iter_mems_events(datafile, id_col='PtID', start_date_col='DateEnroll', chunksize=1000):
+    '''
+        Stream the wide-form MEMS export as long-form event chunks (see melt_mems_events), reading
+        only the id, start date and MEMS columns, chunksize participants' rows at a time
+
+        Duplicates are only dropped within a chunk - write the chunks to an EventStore with
+        dedupe=True to drop them across the whole table.
+
+        Args:
+            datafile: Path to the raw CSV
+
+            id_col: Name of column that stores a participant's unique identifier
+
+            start_date_col: Name of column that stores a participant's study start date
+
+            chunksize: Number of wide-form rows to read at a time
+
+        Returns:
+            A generator of long-form event DataFrames
+    '''
+    from .dataset import Dataset
+
+    header = list(pd.read_csv(datafile, nrows=0).columns)
+    schema = parse_mems_schema(header)
+    mems_cols = {slot['date_col'] for slot in schema} | {slot['time_col'] for slot in schema} | \
+        {col for slot in schema for col in slot['companions'].values() if col in header}
+
+    usecols = [col for col in header if col in (id_col, start_date_col) or col in mems_cols]
+
+    # Dates, times and intervals stay as strings, as in Dataset.from_csv
+    dtype = {col: str for col in usecols if col in mems_cols and not col.endswith(('_numtimes', '_withinrange'))}
+
+    for chunk in pd.read_csv(datafile, usecols=usecols, dtype=dtype, chunksize=chunksize, parse_dates=False):
+        chunk[start_date_col] = pd.to_datetime(chunk[start_date_col], errors='coerce')
+        yield melt_mems_events(Dataset(chunk, id_col=id_col), start_date_col=start_date_col)
+
+def _event_keys(df, id_col, date_col, time_col=None):
+    ''' Hash (id, date, time) - or (id, date) - per row, after normalizing dates so raw and parsed tables agree '''
+    keys = pd.DataFrame({
+        id_col: df[id_col].to_numpy(),
+        date_col: pd.to_datetime(df[date_col], errors='coerce').to_numpy()
+    })
+    if time_col is not None:
+        keys[time_col] = df[time_col].astype('string').to_numpy()
+    return pd.util.hash_pandas_object(keys, index=False)
+
+def append_events(events, delta, id_col='PtID', date_col='date', time_col='time', start_date_col='DateEnroll',
+                  time_of_day_props=TIME_OF_DAY_PROPS, min_study_month=None):
+    '''
+        Incrementally add new MEMS events (e.g., the latest week of smart cap data) to an existing
+        long-form event table, without rebuilding it from the full merged CSV
+
+        New events go through the same steps as the stored table did: if it has been normalized
+        (it has a datetime column), the new events are too (see normalize_events), and if it holds
+        temporal features (study_day, ...), these are computed for the new events. Stored rows
+        without a time (e.g., a day without cap use) are replaced by the delta's rows once real
+        events arrive for that day, as their daily counts are out of date.
+
+        Args:
+            events: The stored long-form event table (e.g., from melt_mems_events or normalize_events)
+
+            delta: A DataFrame or path to a CSV of new events - either long-form, or wide-form
+                with the same MEMS columns as the full export
+
+            id_col: Name of column that stores a participant's unique identifier
+
+            date_col: Name of column that stores the event date
+
+            time_col: Name of column that stores the event time
+
+            start_date_col: Name of column that stores a participant's study start date
+
+            time_of_day_props: Time of day bins and labels, used if the stored table has a time_of_day column
+
+            min_study_month: Drop new events before this study month (e.g., 1 for the washout in analysis.py)
+
+        Returns:
+            A tuple of (updated event table, array of ids of the participants with new events).
+            Only those participants' features need to be recomputed.
+    '''
+    if isinstance(delta, (str, Path)):
+        delta = pd.read_csv(delta, parse_dates=False)
+
+    # Wide-form deltas get reshaped the same way as the full export
+    if not {date_col, time_col}.issubset(delta.columns):
+        from .dataset import Dataset
+        delta = melt_mems_events(Dataset(delta, id_col=id_col), start_date_col=start_date_col)
+
+    # Days that were stored without cap use, but now have events, are replaced by the delta's rows
+    used_days = _event_keys(delta.loc[delta[time_col].notna()], id_col, date_col)
+    superseded = events[time_col].isna() & _event_keys(events, id_col, date_col).isin(used_days)
+    events = events.loc[~superseded.to_numpy()]
+
+    stored = _event_keys(events, id_col, date_col, time_col)
+    incoming = _event_keys(delta, id_col, date_col, time_col)
+
+    # Keep only events we haven't seen yet (and only one copy of each)
+    is_new = ~incoming.isin(stored) & ~incoming.duplicated()
+    new = delta.loc[is_new.to_numpy()]
+
+    if 'datetime' in events.columns:
+        new = normalize_events(new, start_date_col, date_col, time_col)
+
+    if 'used_today' in events.columns:
+        new['used_today'] = (new['num_times_used_today'] > 0).astype(int)
+
+    if 'study_day' in events.columns:
+        from ..features.extract import get_temporal_feats
+        new = get_temporal_feats(new, start_date_col, id_col, time_of_day_props if 'time_of_day' in events.columns
+                                 else None, inplace=False)
+
+        if min_study_month is not None:
+            new = new.loc[new['study_month'] >= min_study_month]
+
+    new = new.reindex(columns=events.columns)
+
+    # Match the stored table's datetime columns, so the concat doesn't fall back to objects
+    for col in events.select_dtypes('datetime').columns:
+        new[col] = pd.to_datetime(new[col], errors='coerce')
+
+    affected = new[id_col].unique()
+    print('%d new events for %d participants (%d placeholder rows replaced).' %
+          (len(new), len(affected), superseded.sum()))
+
+    return pd.concat([events, new], ignore_index=True), affected
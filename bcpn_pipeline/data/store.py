@@ -0,0 +1,197 @@
+import json
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from .cache import read_frame, write_frame
+from .events import drop_duplicate_events
+
+MANIFEST_NAME = 'manifest.json'
+
+def concat_frames(frames):
+    '''
+        Concatenate DataFrames that were computed separately (e.g., one per shard), keeping
+        categorical columns categorical even when each frame only observed some of the categories
+
+        Args:
+            frames: List of pandas DataFrames with the same columns
+
+        Returns:
+            A pandas DataFrame with a fresh index
+    '''
+    res = pd.concat(frames, ignore_index=True)
+
+    for col in {col for df in frames for col in df.select_dtypes('category').columns}:
+        dtypes = [df[col].dtype for df in frames if col in df.columns]
+        if all(dtype == dtypes[0] for dtype in dtypes):
+            res[col] = res[col].astype(dtypes[0])
+        else:
+            # Same categories we'd get from building the categorical on the full frame
+            categories = sorted(set().union(*[dtype.categories for dtype in dtypes
+                                              if isinstance(dtype, pd.CategoricalDtype)]))
+            res[col] = pd.Categorical(res[col], categories=categories)
+    return res
+
+class EventStore:
+    '''
+        An event table partitioned by participant, stored as one columnar file per shard
+        of participants plus a small JSON manifest - so the pipeline never needs the whole
+        table in memory at once
+
+        To build one out of core, stream the export into it:
+            EventStore.write(iter_mems_events(datafile), path, dedupe=True)
+    '''
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / MANIFEST_NAME) as f:
+            manifest = json.load(f)
+
+        self.id_col = manifest['id_col']
+        self.columns = manifest['columns']
+        self.shards = manifest['shards']
+
+    @classmethod
+    def write(cls, frames, path, id_col='PtID', ids_per_shard=50, dedupe=False):
+        '''
+            Partition an event table by participant and write it to disk - from a single DataFrame,
+            or chunk by chunk (e.g., from iter_mems_events), so the whole table is never in memory
+
+            Participants are assigned to shards in order of first appearance (in id order, for a
+            single DataFrame). Each chunk's rows are appended to their participants' shards, so a
+            participant may span chunks but always lands in one shard.
+
+            Args:
+                frames: A pandas DataFrame (e.g., the long-form MEMS events), or an iterable of
+                    DataFrames with the same columns
+
+                path: Directory for the shard files and manifest
+
+                id_col: Name of column that stores a participant's unique identifier
+
+                ids_per_shard: Number of participants per shard file
+
+                dedupe: Whether to drop duplicate rows within each shard (e.g., participants repeated
+                    in different chunks) - the same as dropping them from the whole table
+
+            Returns:
+                An EventStore object
+        '''
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        # Sort once, then every shard holds a contiguous range of ids
+        if isinstance(frames, pd.DataFrame):
+            frames = [frames.sort_values(by=id_col, kind='stable')]
+
+        shards, assigned, columns = [], {}, []
+        for chunk in frames:
+            columns = columns or list(chunk.columns)
+
+            # New participants fill up the last shard, then start a new one
+            for pid in pd.unique(chunk[id_col]).tolist():
+                if pid not in assigned:
+                    if not shards or len(shards[-1]['ids']) == ids_per_shard:
+                        shards.append({'name': 'shard_%05d' % len(shards), 'ids': [], 'n_rows': 0})
+                    shards[-1]['ids'].append(pid)
+                    assigned[pid] = len(shards) - 1
+
+            shard_idx = chunk[id_col].map(assigned).to_numpy()
+            for i in np.unique(shard_idx):
+                shard = shards[i]
+                rows = chunk[shard_idx == i]
+
+                # Append to what earlier chunks wrote for this shard
+                stored = read_frame(path / shard['name']) if shard['n_rows'] else None
+                df = concat_frames([stored, rows]) if stored is not None else rows
+                df = df.sort_values(by=id_col, kind='stable').reset_index(drop=True)
+
+                if dedupe:
+                    df = drop_duplicate_events(df)
+
+                write_frame(df, path / shard['name'])
+                shard['n_rows'] = len(df)
+
+        cls._write_manifest(path, id_col, columns, shards)
+        return cls(path)
+
+    @staticmethod
+    def _write_manifest(path, id_col, columns, shards):
+        with open(Path(path) / MANIFEST_NAME, 'w') as f:
+            json.dump({'id_col': id_col, 'columns': columns, 'shards': shards}, f, default=str)
+
+    def __len__(self):
+        return sum(shard['n_rows'] for shard in self.shards)
+
+    def __iter__(self):
+        return self.iter_shards()
+
+    def iter_shards(self, ids=None):
+        ''' Yield one shard's DataFrame at a time, optionally only the shards (and rows) for the given ids '''
+        wanted = set(ids) if ids is not None else None
+        for shard in self.shards:
+            if wanted is not None and wanted.isdisjoint(shard['ids']):
+                continue
+
+            df = read_frame(self.path / shard['name'])
+            if wanted is not None:
+                df = df[df[self.id_col].isin(wanted)]
+            yield df
+
+    def read(self, ids=None):
+        ''' Load the rows for the given participants (or everyone) into a single DataFrame '''
+        return concat_frames(list(self.iter_shards(ids)))
+
+    def map(self, func, *args, **kwargs):
+        '''
+            Apply a per-participant function shard by shard and concatenate the results in shard order
+
+            Works for anything that only needs one participant's rows at a time, e.g.:
+                store.map(features.get_temporal_feats, start_date_col='DateEnroll', id_col='PtID',
+                          time_of_day_props=consts.TIME_OF_DAY_PROPS)
+                store.map(features.calc_standard_temporal_metrics, ['PtID', 'study_week'], 'datetime')
+                store.map(lambda df: Featureset(df, ...).get_lagged_featureset(n_lags).df)
+
+            Args:
+                func: Function taking a shard's DataFrame as its first argument and returning a DataFrame
+                args, kwargs: Passed on to func
+
+            Returns:
+                A pandas DataFrame
+        '''
+        return concat_frames([func(df, *args, **kwargs) for df in self.iter_shards()])
+
+    def replace_participants(self, df, ids_per_shard=50):
+        '''
+            Rewrite only the shards holding the participants in df (e.g., after append_events),
+            and put any new participants into new shards
+
+            Args:
+                df: A pandas DataFrame holding the complete, updated rows for some participants
+                ids_per_shard: Number of participants per new shard file
+        '''
+        ids = set(df[self.id_col].unique().tolist())
+        stored = set()
+
+        for shard in self.shards:
+            overlap = ids.intersection(shard['ids'])
+            if not overlap:
+                continue
+
+            old = read_frame(self.path / shard['name'])
+            new = concat_frames([old[~old[self.id_col].isin(overlap)],
+                                 df[df[self.id_col].isin(overlap)][old.columns]])
+            new = new.sort_values(by=self.id_col, kind='stable').reset_index(drop=True)
+
+            write_frame(new, self.path / shard['name'])
+            shard['n_rows'] = len(new)
+            stored |= overlap
+
+        new_ids = sorted(ids - stored)
+        for i in range(0, len(new_ids), ids_per_shard):
+            shard_ids = new_ids[i:i + ids_per_shard]
+            shard = df[df[self.id_col].isin(shard_ids)].sort_values(by=self.id_col, kind='stable')
+            name = 'shard_%05d' % len(self.shards)
+            write_frame(shard[self.columns].reset_index(drop=True), self.path / name)
+            self.shards.append({'name': name, 'ids': shard_ids, 'n_rows': len(shard)})
+
+        self._write_manifest(self.path, self.id_col, self.columns, self.shards)
@@ -1,3 +1,8 @@
 from .common import *
 from .extract import *
 from .featureset import *
+from .eventlog import *
+from .horizons import *
+from .parallel import *
+from .lags import *
+from .collinearity import *
@@ -0,0 +1,188 @@
+import numpy as np
+import pandas as pd
+
+def standardize(df, dtype=np.float32):
+    '''
+        Center and scale each column to unit norm, so dot products between columns are correlations
+
+        Missing values are set to the column mean (0 after centering), and constant columns
+        are left at 0 - so they are uncorrelated with everything.
+
+        Args:
+            df: A pandas DataFrame of numeric columns
+            dtype: Float dtype of the result (float32 halves the memory of float64)
+
+        Returns:
+            A (rows x columns) numpy array
+    '''
+    X = df.to_numpy(dtype=np.float64)
+    X = X - np.nanmean(X, axis=0) if len(X) else X
+    X = np.nan_to_num(X, nan=0.0)
+
+    norms = np.linalg.norm(X, axis=0)
+    X = np.divide(X, norms, out=np.zeros_like(X), where=norms > 0)
+    return np.asfortranarray(X, dtype=dtype)
+
+def prune_correlated(df, cols=None, threshold=0.85, block_size=256, dtype=np.float32):
+    '''
+        Greedily drop features that are correlated with a feature that is being kept
+
+        Columns are visited in order: a column is dropped if its correlation with any earlier,
+        kept column is greater than threshold (signed, so strong negative correlations are kept).
+        Correlations are computed one block of columns at a time against the kept columns only,
+        so the full correlation matrix is never built.
+
+        Args:
+            df: A pandas DataFrame
+            cols (optional): Columns to consider, in the order they should be visited. Defaults to
+                all numeric columns.
+            threshold: Correlation above which a feature is dropped
+            block_size: Number of columns per block
+            dtype: Float dtype used for the correlations
+
+        Returns:
+            A tuple of (list of columns to drop, DataFrame of the offending pairs with columns
+            feature, correlated_with and corr)
+    '''
+    if cols is None:
+        cols = list(df.select_dtypes('number').columns)
+
+    Z = standardize(df[cols], dtype=dtype)
+    kept = []
+    to_drop, pairs = [], []
+
+    for start in range(0, len(cols), block_size):
+        block = np.arange(start, min(start + block_size, len(cols)))
+
+        # Correlations with everything kept so far, and within the block
+        against_kept = Z[:, kept].T @ Z[:, block] if kept else np.empty((0, len(block)), dtype=dtype)
+        within = Z[:, block].T @ Z[:, block]
+
+        kept_in_block = []
+        for k, j in enumerate(block):
+            partners = [(kept[i], against_kept[i, k]) for i in np.flatnonzero(against_kept[:, k] > threshold)]
+            partners += [(block[i], within[i, k]) for i in kept_in_block if within[i, k] > threshold]
+
+            if partners:
+                to_drop.append(cols[j])
+                pairs += [(cols[j], cols[i], float(r)) for i, r in partners]
+            else:
+                kept_in_block.append(k)
+
+        kept += [block[k] for k in kept_in_block]
+
+    return to_drop, pd.DataFrame(pairs, columns=['feature', 'correlated_with', 'corr'])
+
+def _vif_columns(featureset, exclude=None):
+    ''' Numeric feature columns of a Featureset (or DataFrame), minus its id and target columns '''
+    if isinstance(featureset, pd.DataFrame):
+        df, skip = featureset, []
+    else:
+        df, skip = featureset.df, [featureset.id_col, featureset.target_col]
+
+    skip = set(skip + list(exclude or []))
+    cols = [col for col in df.select_dtypes('number').columns if col not in skip]
+    return df[cols].dropna()
+
+def _gram(df, centered=True):
+    '''
+        (Centered or uncentered) correlation matrix of the columns of df
+
+        With centered=True, VIFs match regressing each feature on the others with an intercept.
+        With centered=False, they match statsmodels' variance_inflation_factor as pinned in
+        environment.yml, which regresses without one (newer releases standardize first, which
+        gives the centered values).
+    '''
+    X = df.to_numpy(dtype=np.float64)
+    if centered:
+        X = X - X.mean(axis=0)
+
+    norms = np.linalg.norm(X, axis=0)
+    X = X / np.where(norms > 0, norms, 1)
+    return X.T @ X
+
+def _inverse(gram):
+    '''
+        Pseudo-inverse of a correlation matrix, plus a mask of the features that are perfectly
+        collinear with others (their VIF is infinite). For every other feature, the diagonal
+        of the pseudo-inverse is still its exact VIF.
+    '''
+    if not len(gram):
+        return gram, np.zeros(0, dtype=bool)
+
+    eigvals, eigvecs = np.linalg.eigh(gram)
+    ok = eigvals > eigvals.max() * len(gram) * np.finfo(np.float64).eps
+
+    inv = (eigvecs[:, ok] / eigvals[ok]) @ eigvecs[:, ok].T
+    collinear = (np.abs(eigvecs[:, ~ok]) > np.sqrt(np.finfo(np.float64).eps)).any(axis=1)
+    return inv, collinear
+
+def _vifs(inv, collinear):
+    return np.where(collinear, np.inf, np.diag(inv))
+
+def vif_table(featureset, exclude=None, centered=True):
+    '''
+        Variance inflation factor of every feature at once, from the diagonal of the inverse
+        correlation matrix (instead of one regression per feature)
+
+        Args:
+            featureset: A Featureset (its id and target columns are skipped) or a DataFrame
+
+            exclude (optional): List of other columns to leave out
+
+            centered: If True (the default), the VIF of a feature regressed on the others with
+                an intercept. Set to False for the uncentered VIF that statsmodels 0.13's
+                variance_inflation_factor computes.
+
+        Returns:
+            A DataFrame with columns feature and VIF (rows with missing values are ignored,
+            perfectly collinear features get an infinite VIF)
+    '''
+    df = _vif_columns(featureset, exclude)
+    inv, collinear = _inverse(_gram(df, centered=centered))
+
+    return pd.DataFrame({'feature': df.columns, 'VIF': _vifs(inv, collinear)})
+
+def drop_high_vif(featureset, threshold=10, exclude=None, centered=True):
+    '''
+        Repeatedly drop the feature with the highest VIF until all are at or below threshold
+
+        The inverse correlation matrix is computed once, then updated for each dropped feature
+        (the inverse of a submatrix follows from the full inverse), so each step is O(p^2).
+
+        Args:
+            featureset: A Featureset (its id and target columns are skipped) or a DataFrame
+            threshold: Largest acceptable VIF
+            exclude (optional): List of other columns to leave out
+            centered: Whether to center the features first (see vif_table)
+
+        Returns:
+            A tuple of (vif_table of the remaining features, DataFrame of the dropped features
+            with the VIF they had when dropped, in drop order)
+    '''
+    df = _vif_columns(featureset, exclude)
+    gram = _gram(df, centered=centered)
+    inv, collinear = _inverse(gram)
+    cols = list(df.columns)
+    dropped = []
+
+    while cols:
+        vifs = _vifs(inv, collinear)
+        worst = int(np.argmax(vifs))
+        if vifs[worst] <= threshold:
+            break
+
+        dropped.append((cols.pop(worst), vifs[worst]))
+        keep = np.arange(len(vifs)) != worst
+        gram = gram[np.ix_(keep, keep)]
+
+        if collinear.any():
+            # The update only holds for a true inverse - start over from the smaller matrix
+            inv, collinear = _inverse(gram)
+        else:
+            # Remove row and column `worst` from the inverse
+            inv = inv[np.ix_(keep, keep)] - np.outer(inv[keep, worst], inv[worst, keep]) / inv[worst, worst]
+            collinear = collinear[keep]
+
+    return (pd.DataFrame({'feature': cols, 'VIF': _vifs(inv, collinear)}),
+            pd.DataFrame(dropped, columns=['feature', 'VIF']))
@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+
+# Missing timestamps (NaT) are stored as the smallest int64, same as numpy's own NaT
+NAT = np.iinfo(np.int64).min
+
+# Default flag columns and the narrowest dtypes that hold them
+FLAG_DTYPES = {
+    'withinrange': np.int8,
+    'num_times_used_today': np.int16
+}
+
+class EventLog:
+    '''
+        Compact, array-backed store of MEMS events.
+
+        Events are sorted once by participant and time, and kept in contiguous arrays
+        (int64 epoch nanoseconds plus narrow integer flags). offsets[i]:offsets[i+1] is the
+        range of participant ids[i]'s events, so slicing out one participant is O(1) and
+        returns views, not copies.
+    '''
+    def __init__(self, ids, offsets, timestamps, flags, id_col='PtID', datetime_col='datetime'):
+        self.ids = ids
+        self.offsets = offsets
+        self.timestamps = timestamps
+        self.flags = flags
+        self.id_col = id_col
+        self.datetime_col = datetime_col
+
+        self._positions = {pid: i for i, pid in enumerate(ids.tolist())}
+
+    @classmethod
+    def from_frame(cls, df, id_col='PtID', datetime_col='datetime', flag_dtypes=FLAG_DTYPES):
+        '''
+            Build an EventLog from a long-form event DataFrame
+
+            Args:
+                df: A pandas DataFrame with one row per event
+
+                id_col: Name of column that stores a participant's unique identifier
+
+                datetime_col: Name of column that stores the event's combined datetime
+
+                flag_dtypes: Dictionary of flag column, numpy dtype pairs (missing flags become 0)
+
+            Returns:
+                An EventLog object
+        '''
+        ids = df[id_col].to_numpy()
+        timestamps = df[datetime_col].to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+        # Sort by participant, then time - with missing times last
+        sort_key = np.where(timestamps == NAT, np.iinfo(np.int64).max, timestamps)
+        order = np.lexsort((sort_key, ids))
+
+        ids = ids[order]
+        unique_ids, starts = np.unique(ids, return_index=True)
+        offsets = np.append(starts, len(ids)).astype(np.int64)
+
+        flags = {
+            col: df[col].fillna(0).to_numpy()[order].astype(dtype)
+            for col, dtype in flag_dtypes.items() if col in df.columns
+        }
+        return cls(unique_ids, offsets, np.ascontiguousarray(timestamps[order]), flags, id_col=id_col,
+                   datetime_col=datetime_col)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __contains__(self, pid):
+        return pid in self._positions
+
+    def __getitem__(self, pid):
+        return self.participant(pid)
+
+    def participant(self, pid):
+        ''' Get one participant's events, as a dictionary of array views (no copying) '''
+        i = self._positions[pid]
+        start, end = self.offsets[i], self.offsets[i + 1]
+
+        res = {'timestamps': self.timestamps[start:end]}
+        res.update({col: values[start:end] for col, values in self.flags.items()})
+        return res
+
+    def counts(self):
+        ''' Number of events per participant '''
+        return pd.Series(np.diff(self.offsets), index=self.ids)
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.offsets.nbytes + self.timestamps.nbytes + \
+            sum(values.nbytes for values in self.flags.values())
+
+    def to_frame(self):
+        ''' Expand back into a long-form DataFrame '''
+        timestamps = self.timestamps.view('datetime64[ns]')
+        df = pd.DataFrame({
+            self.id_col: np.repeat(self.ids, np.diff(self.offsets)),
+            self.datetime_col: timestamps
+        })
+        for col, values in self.flags.items():
+            df[col] = values
+        return df
+
+    def __repr__(self):
+        return '\n'.join([
+            f'Number of participants: {len(self.ids)}',
+            f'Number of events: {len(self)}',
+            f'Memory: {self.nbytes / 1e6:.2f} MB'
+        ])
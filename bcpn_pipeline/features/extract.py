@@ -7,7 +7,10 @@ import numpy as np
 import pandas as pd
 import datetime
 
-from ..consts import DAYS_IN_WEEK, DAYS_IN_MONTH
+from ..consts import DAYS_IN_WEEK, DAYS_IN_MONTH, SECONDS_IN_HOUR
+from .eventlog import NAT
+
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
     
 def reset_index(df):
     """
@@ -62,6 +65,32 @@ def get_datetime_col(x):
 
     return date
 
+def build_datetime_col(df, date_col='date', time_col='time', fmt='%m/%d/%Y %H:%M:%S'):
+    '''
+        Vectorized alternative to get_datetime_col - combines a date and a time column
+        and parses them all at once with a fixed format
+
+        Args:
+            df: A Pandas DataFrame
+
+            date_col: Name of column that stores dates as strings (e.g., '01/31/2020')
+
+            time_col: Name of column that stores times as strings (e.g., '13:45:00')
+
+            fmt: Format of the combined '<date> <time>' string
+
+        Returns:
+            A tuple of (datetime Series with NaT for invalid rows, number of rows with both
+            a date and a time that could not be parsed and were coerced to NaT)
+    '''
+    combined = df[date_col].astype('string') + ' ' + df[time_col].astype('string')
+    res = pd.to_datetime(combined, format=fmt, errors='coerce')
+
+    n_coerced = int((combined.notna() & res.isna()).sum())
+    if n_coerced:
+        print('%d rows had an unparseable date and time - coerced to NaT.' % n_coerced)
+
+    return res, n_coerced
 
 def mean_days_between_dates(x):
     dates = [date for date in x if type(date)!= pd._libs.tslibs.nattype.NaTType]
@@ -72,7 +101,7 @@ def mean_days_between_dates(x):
     else:
         return np.NaN
 
-def get_temporal_feats(df, start_date_col, id_col, time_of_day_props):
+def get_temporal_feats(df, start_date_col, id_col, time_of_day_props, inplace=True):
     '''
         Extracts common temporal features of interest (day, week, month, time of day, etc)
         
@@ -88,31 +117,58 @@ def get_temporal_feats(df, start_date_col, id_col, time_of_day_props):
                 Example: An array [-1, 5, 23] creates two time divisions, where `datetime`s with hour between 0 (12am) and 5 (5am) are in one "time of day" bin, and `datetime`s with hour between 5 (5:01am) and 23 (11:59pm) are in another "time of day" bin.
                                         
             time_of_day_props (optional):
+
+            inplace (optional): If True (the default), the new columns are written straight into df. 
+                Otherwise, a copy of df is returned.
     
     '''
-    df['hour'] = df['datetime'].dt.hour
+    if not inplace:
+        df = df.copy()
+
+    hours = df['datetime'].dt.hour
+    df['hour'] = hours
 
     if time_of_day_props:
-        df['time_of_day'] = pd.cut(df['datetime'].dt.hour, time_of_day_props['bins'], labels=time_of_day_props['labels'])
-
-    df['is_weekday'] = df['datetime'].apply(
-        lambda x: 1 if x.day_name() != "Saturday" and x.day_name() != "Sunday" else 0
-    )
-                                      
-    df['study_day'] = (df['date'] - df[start_date_col]).dt.days
-    df['day_of_week'] = df['date'].dt.day_name()
-    df['study_week'] = np.floor((df['date']- df[start_date_col]).dt.days / DAYS_IN_WEEK)
+        df['time_of_day'] = pd.cut(hours, time_of_day_props['bins'], labels=time_of_day_props['labels'])
+
+    # Rows without a time (NaT) count as weekdays, as they always have
+    df['is_weekday'] = (~(df['datetime'].dt.dayofweek >= 5)).astype(int)
+
+    # Compute the offset once, then derive each horizon from it
+    days = (df['date'] - df[start_date_col]).dt.days
+    df['study_day'] = days
+    df['day_of_week'] = get_day_of_week_col(df['date'])
+    df['study_week'] = days // DAYS_IN_WEEK
     
     # Estimate of month
-    df['study_month'] = np.floor((df['date']- df[start_date_col]).dt.days / DAYS_IN_MONTH)
-    
-    for col in ['time_of_day', 'day_of_week']:
-        
-        # Explicitly set dtype
-        df[col] = df[col].astype('category') 
+    df['study_month'] = days // DAYS_IN_MONTH
 
     return df
 
+def get_day_of_week_col(dates):
+    '''
+        Day names as a categorical, built straight from dt.dayofweek codes
+
+        Args:
+            dates: A pandas Series of datetimes
+
+        Returns:
+            A categorical Series, with the observed day names as categories (sorted, as astype('category') would)
+    '''
+    dow = dates.dt.dayofweek.to_numpy(dtype=float)
+    missing = np.isnan(dow)
+    dow = np.where(missing, 0, dow).astype(int)
+
+    observed = np.unique(dow[~missing])
+    names = np.array(DAY_NAMES, dtype=object)[observed]
+    order = np.argsort(names, kind='stable')
+
+    lookup = np.full(len(DAY_NAMES), -1)
+    lookup[observed[order]] = np.arange(len(observed))
+    codes = np.where(missing, -1, lookup[dow])
+
+    return pd.Series(pd.Categorical.from_codes(codes, categories=names[order]), index=dates.index)
+
 def calc_standard_static_metrics(df, cols, col_prefix):
     
     df[col_prefix + 'mean'] = df[cols].mean(axis=1)
@@ -123,35 +179,128 @@ def calc_standard_static_metrics(df, cols, col_prefix):
     newcols = [col_prefix + metric for metric in ['mean', 'std', 'min', 'max']]
     return df, newcols
 
+def group_code_counts(group_codes, cat_codes, n_groups, n_cats):
+    '''
+        Count how often each category occurs in each group, with one bincount over group x category
+
+        Args:
+            group_codes: Integer array with each row's group code, in [0, n_groups) - or -1 to skip the row
+
+            cat_codes: Integer array with each row's category code (e.g., Series.cat.codes) - -1 for missing
+
+            n_groups: Total number of groups
+
+            n_cats: Total number of categories
+
+        Returns:
+            An int64 array of shape (n_groups, n_cats)
+    '''
+    valid = (group_codes >= 0) & (cat_codes >= 0)
+    flat = group_codes[valid].astype(np.int64) * n_cats + cat_codes[valid]
+    return np.bincount(flat, minlength=n_groups * n_cats).reshape(n_groups, n_cats)
+
+def group_presence(group_codes, cat_codes, n_groups, n_cats):
+    '''
+        Per-group bitmask of the categories that occur at least once (bit i set = category i present)
+
+        Only for up to 63 categories, since the mask is an int64 - beyond that, use
+        group_code_counts(...) > 0 directly.
+    '''
+    if n_cats > 63:
+        raise ValueError(f'group_presence packs at most 63 categories into an int64 bitmask, got {n_cats}')
+
+    present = group_code_counts(group_codes, cat_codes, n_groups, n_cats) > 0
+    return present.astype(np.int64) @ (np.int64(1) << np.arange(n_cats, dtype=np.int64))
+
+def unpack_presence(bitmasks, n_cats):
+    ''' Expand presence bitmasks into a (n_groups, n_cats) array of 0/1 indicators '''
+    return (bitmasks[:, None] >> np.arange(n_cats)) & 1
+
+def group_mode(group_codes, cat_codes, n_groups, n_cats):
+    '''
+        Most common category per group - ties go to the lowest code, as with Series.mode on a categorical
+
+        Returns:
+            An int64 array of category codes, -1 for groups without any (non-missing) category
+    '''
+    counts = group_code_counts(group_codes, cat_codes, n_groups, n_cats)
+    return np.where(counts.sum(axis=1) > 0, counts.argmax(axis=1), -1)
+
+def _segment_mean_std(codes, values, n_groups):
+    ''' Per-group mean and sample std (ddof=1) of values, for codes sorted or not - NaN where undefined '''
+    counts = np.bincount(codes, minlength=n_groups)
+    sums = np.bincount(codes, weights=values, minlength=n_groups)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+
+        # Two passes, so the variance doesn't suffer from cancellation
+        sq_devs = np.bincount(codes, weights=(values - means[codes]) ** 2, minlength=n_groups)
+        stds = np.sqrt(np.where(counts > 1, sq_devs / (counts - 1), np.nan))
+    return means, stds
+
+def segment_temporal_metrics(codes, n_groups, timestamps):
+    '''
+        Compute the standard temporal metrics for every group at once
+
+        Events are sorted a single time by (group, timestamp); each metric is then a
+        vectorized segment reduction instead of a Python function called per group.
+
+        Args:
+            codes: Integer array with each event's group code, in [0, n_groups) - or -1 to exclude the event
+
+            n_groups: Total number of groups
+
+            timestamps: int64 array of epoch nanoseconds (NaT is skipped)
+
+        Returns:
+            A dictionary of metric name, float array (one value per group, floored, NaN where undefined)
+    '''
+    valid = (codes >= 0) & (timestamps != NAT)
+    codes, timestamps = codes[valid], timestamps[valid]
+
+    order = np.lexsort((timestamps, codes))
+    codes, timestamps = codes[order], timestamps[order]
+
+    # Hour of day of each event
+    hours = (timestamps // int(SECONDS_IN_HOUR * 1e9)) % 24
+    hour_mean, hour_std = _segment_mean_std(codes, hours.astype(float), n_groups)
+
+    # Time between consecutive events within the same group, in hours
+    same = codes[1:] == codes[:-1]
+    diffs = (timestamps[1:] - timestamps[:-1])[same] / 1e9 / SECONDS_IN_HOUR
+    diff_mean, diff_std = _segment_mean_std(codes[1:][same], diffs, n_groups)
+
+    return {
+        'event_time_mean': np.floor(hour_mean),
+        'event_time_std': np.floor(hour_std),
+        'between_event_time_mean': np.floor(np.abs(diff_mean)),
+        'between_event_time_std': np.floor(diff_std)
+    }
+
 def calc_standard_temporal_metrics(df, groupby_cols, datetime_col):
-    # TODO: Move to consts
-    SECONDS_IN_HOUR = 3600.0
-    
-    res = df.groupby(groupby_cols).agg(
-        event_time_mean=(
-            datetime_col, 
-            lambda x: np.floor(
-                x.dt.hour.mean()
-            )
-        ),
-        event_time_std=(
-            datetime_col, 
-            lambda x: np.floor(
-                x.dt.hour.std()
-            )
-        ),
-        between_event_time_mean=(
-            datetime_col, 
-            lambda x: np.floor(
-                abs(x.diff().mean().total_seconds() / SECONDS_IN_HOUR)
-            )
-        ),
-        between_event_time_std= (
-            datetime_col, 
-            lambda x: np.floor(
-                x.diff().std().total_seconds() / SECONDS_IN_HOUR
-            )
-        )
-    ).reset_index().fillna(0)
-    return res
-    
\ No newline at end of file
+    '''
+        Mean and std of event hour, and of the hours between consecutive events, per group
+
+        Args:
+            df: A Pandas DataFrame
+
+            groupby_cols: List of columns to group by (e.g., id column and horizon)
+
+            datetime_col: Name of column that stores the event's combined datetime
+
+        Returns:
+            A DataFrame with the groupby columns and one column per metric (undefined metrics are 0)
+    '''
+    grouped = df.groupby(groupby_cols, sort=True, observed=True)
+
+    # Events with a missing group key get -1, and are left out
+    codes = grouped.ngroup().fillna(-1).to_numpy().astype(np.int64)
+    res = grouped.size().reset_index()[groupby_cols]
+
+    timestamps = df[datetime_col].to_numpy(dtype='datetime64[ns]').view(np.int64)
+    metrics = segment_temporal_metrics(codes, len(res), timestamps)
+
+    for name, values in metrics.items():
+        res[name] = values
+    return res.fillna(0)
@@ -1,11 +1,86 @@
+import collections
+import functools
+import hashlib
 import numpy as np
 import pandas as pd
 from itertools import compress
 
 from ..consts import TARGET_HORIZONS
+from .collinearity import prune_correlated
+
+# How one_hot_encode stores dummy columns: as pd.get_dummies does, as int8 arrays, or as sparse int8 arrays
+ENCODINGS = ['dense', 'int8', 'sparse']
+
+# Number of stage outputs (e.g., encoded or lagged featuresets) kept by memoized_stage
+STAGE_CACHE_SIZE = 16
+_stage_cache = collections.OrderedDict()
+
+def clear_stage_cache():
+    _stage_cache.clear()
+
+def column_hashes(df):
+    ''' Content hash of the index and of each column (name, dtype and values) - one cheap pass per column '''
+    hashes = [hashlib.sha1(pd.util.hash_pandas_object(df.index).to_numpy().tobytes()).hexdigest()]
+    for col, values in df.items():
+        h = hashlib.sha1(repr((col, str(values.dtype))).encode())
+        h.update(pd.util.hash_pandas_object(values, index=False).to_numpy().tobytes())
+        hashes.append(h.hexdigest())
+    return tuple(hashes)
+
+def stage_key(fs, stage, args, kwargs):
+    ''' Everything a stage's output depends on: the df's contents, the metadata and the arguments '''
+    meta = (fs.name, fs.id_col, fs.nominal_cols, fs.target_col, fs.horizon, fs.n_lags,
+            sorted(fs.category_map.items(), key=repr), fs.correlated_pairs)
+    return (stage, column_hashes(fs.df), repr(meta), repr(args), repr(sorted(kwargs.items())))
+
+def memoized_stage(method):
+    '''
+        Cache a Featureset stage's output, keyed by the content of the Featureset (see stage_key)
+        and the stage's arguments - so repeated sweeps reuse e.g. the encoded featureset instead
+        of recomputing it. Least recently used outputs are evicted past STAGE_CACHE_SIZE.
+
+        Featuresets come back as shallow copies: their df shares the cached column buffers, but
+        adding, dropping or reassigning columns (or any attribute) never affects the cached output.
+        Writing into a column in place would, so the output's own hashes are checked on every hit,
+        and a changed entry is recomputed.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = stage_key(self, method.__name__, args, kwargs)
+        entry = _stage_cache.get(key)
+
+        if entry is not None and isinstance(entry[0], Featureset) and column_hashes(entry[0].df) != entry[1]:
+            print('Cached %s output was modified in place - recomputing.' % method.__name__)
+            entry = None
+
+        if entry is None:
+            res = method(self, *args, **kwargs)
+            entry = (res, column_hashes(res.df) if isinstance(res, Featureset) else None)
+            _stage_cache[key] = entry
+            if len(_stage_cache) > STAGE_CACHE_SIZE:
+                _stage_cache.popitem(last=False)
+        else:
+            _stage_cache.move_to_end(key)
+
+        res = entry[0]
+        if not isinstance(res, Featureset):
+            return res
+        return res.copy(df=res.df.copy(deep=False))
+    return wrapper
 
 class Featureset:
-    def __init__(self, df, name, id_col, nominal_cols=None, target_col=None, horizon=None, n_lags=None):
+    '''
+        A feature DataFrame plus the metadata needed to model it.
+
+        Transformations (one_hot_encode, handle_multicollinearity, get_lagged_featureset,
+        prep_for_modeling, ...) never modify the Featureset - they return a new one.
+
+        Stage outputs are cached by content (see memoized_stage), so modifying a Featureset
+        in any way - reassigning fs.df, changing values in place, or changing its metadata -
+        just means the next stage call is a cache miss.
+    '''
+    def __init__(self, df, name, id_col, nominal_cols=None, target_col=None, horizon=None, n_lags=None,
+                 category_map=None, correlated_pairs=None):
         self.df = df
         self.name = name
         self.id_col = id_col
@@ -18,7 +93,24 @@ class Featureset:
         self.nominal_cols = []
         if nominal_cols:
             self.nominal_cols += nominal_cols
-        
+
+        # Dummy column -> (original categorical column, category), filled in by one_hot_encode
+        self.category_map = dict(category_map or {})
+
+        # Pairs of features found to be highly correlated, filled in by handle_multicollinearity
+        self.correlated_pairs = correlated_pairs
+
+    def copy(self, **changes):
+        ''' Copy (the DataFrame too, unless a new one is given), with any attributes replaced '''
+        attrs = {
+            'df': self.df.copy() if 'df' not in changes else None, 'name': self.name, 'id_col': self.id_col,
+            'nominal_cols': list(self.nominal_cols), 'target_col': self.target_col,
+            'horizon': self.horizon, 'n_lags': self.n_lags, 'category_map': dict(self.category_map),
+            'correlated_pairs': self.correlated_pairs
+        }
+        attrs.update(changes)
+        return Featureset(**attrs)
+
     def prune_nominals(self):
         print('Pruning the nominal columns.')
         nominal_cols = [col for col in self.nominal_cols if 
@@ -28,110 +120,147 @@ class Featureset:
 
         self.nominal_cols = nominal_cols
         
-    def one_hot_encode(self):
+    @memoized_stage
+    def one_hot_encode(self, encoding='dense'):
         print('Doing one-hot encoding.')
 
         '''One-hot encode categoricals
            We'll want to add any new columns to our list of nominal columsn - use python magic to make it happen
+           With encoding='int8' or 'sparse', dummies are stored as (sparse) int8 columns instead
         '''
-        cols_og = self.df.columns
-        self.df = pd.get_dummies(self.df, columns=self.df.select_dtypes('category').columns)
-        cols_all = self.df.columns
-        self.nominal_cols += list(set(cols_all) - set(cols_og))
+        if encoding not in ENCODINGS:
+            raise ValueError('encoding must be one of %s, got %s.' % (ENCODINGS, encoding))
+
+        categoricals = self.df.select_dtypes('category').columns
+        category_map = dict(self.category_map, **get_category_map(self.df, categoricals))
+        nominal_cols = list(self.nominal_cols)
+
+        if encoding == 'dense':
+            # uint8, so newer pandas (which defaults to bool) doesn't drop the dummies below
+            df = pd.get_dummies(self.df, columns=categoricals, dtype=np.uint8)
+            nominal_cols += list(set(df.columns) - set(self.df.columns))
+        else:
+            df, dummy_cols = encode_dummies(self.df, categoricals, sparse=(encoding == 'sparse'))
+            nominal_cols += dummy_cols
+
+            # Nominal columns that were already 0/1 (e.g., time of day indicators) can be just as compact
+            # - but not the id or the target (the labels must stay dense), which aren't pruned yet
+            df = compact_binary(df, [col for col in nominal_cols if col not in (self.id_col, self.target_col)],
+                                sparse=(encoding == 'sparse'))
 
         # Exclude datetimes /non-numerics
-        self.df = self.df.select_dtypes('number') # Assumes target col is numeric
+        df = df.select_dtypes('number') # Assumes target col is numeric
         
-        self.prune_nominals()
+        fs = self.copy(df=df, nominal_cols=nominal_cols, category_map=category_map)
+        fs.prune_nominals()
+        return fs
         
+    @memoized_stage
     def get_lagged_featureset(self, n_lags):
         print('Getting lagged features.')
-        '''Generate lagged observations for temporal data, for each subject '''
-        rows = []
-
-        for unique_id in self.df[self.id_col].unique(): 
-
-            # Filter by subject
-            subset = self.df[self.df[self.id_col] == unique_id]
-
-            # Sort by horizon
-            subset.sort_values(by=self.horizon, ascending=True)
-
-            # Get features as supervised learning df
-            # Temporal features will be lagged by a window of size 3
-            agg = series_to_supervised(subset.iloc[:, 1:], time_col = self.horizon, target_col = self.target_col, 
-                                       n_in=n_lags, n_out=1) 
-
-            # Be sure to add the unique id column back in, at the very beginning
-            agg.insert(0, self.id_col, unique_id)
-
-            # Add to list of dfs to concatenate together
-            rows.append(agg)
-
-        # Get all subjects' lagged features together
-        res = pd.concat(rows, axis=0)
-        
-        # Be sure to reset the index!
-        res = res.reset_index(drop=True)
+        '''Generate lagged observations for temporal data, for each subject.
+           Rows are sorted by horizon within each subject, and all subjects are lagged at once'''
+        res = lag_features(self.df, id_col=self.id_col, time_col=self.horizon,
+                           target_col=self.target_col, n_lags=n_lags)
         
         # Finally, get a new list of nominal feats that mirrors the lagged structure
         mask = [any(col_og in col for col_og in self.nominal_cols) for col in res.columns]
         nominal_cols = list(compress(list(res.columns), mask))
-        self.prune_nominals()
 
         return Featureset(df=res, name=self.name, nominal_cols=nominal_cols, 
-                          id_col=self.id_col, target_col=self.target_col, n_lags=n_lags)
+                          id_col=self.id_col, target_col=self.target_col, n_lags=n_lags,
+                          category_map=lag_category_map(self.category_map, res.columns))
     
-    def handle_multicollinearity(self):
+    @memoized_stage
+    def handle_multicollinearity(self, threshold=0.85):
         print('Handling multicollinearity...')
-        cols = [col for col in self.df.columns if col != self.id_col 
+        # Only numeric columns have correlations (e.g., categoricals haven't been encoded yet)
+        cols = [col for col in self.df.select_dtypes('number').columns if col != self.id_col 
                 and col != self.target_col
                 and col not in TARGET_HORIZONS]
         
-        corr_matrix = self.df[cols].corr()
-
-        # --- Credit to Chris Albon ---
-        # https://chrisalbon.com/code/machine_learning/feature_selection/drop_highly_correlated_features/
-
-        # Select upper triangle of correlation matrix
-        upper = corr_matrix.where(np.triu(np.ones(corr_matrix.shape), k=1).astype(np.bool))
-
-        # Find index of feature columns with correlation greater than 0.85
-        to_drop = [column for column in upper.columns if any(upper[column] > 0.85)]
+        # Greedy, blocked pruning - a feature is dropped if it's correlated with one we keep
+        # The offending pairs are kept as correlated_pairs on the returned featureset
+        to_drop, pairs = prune_correlated(self.df, cols, threshold=threshold)
         
         if len(to_drop) > 0:
-            self.df.drop(columns=to_drop, axis=1, inplace=True)
+            print('Dropping %d correlated features.' % len(to_drop))
 
-        self.prune_nominals()
+        fs = self.copy(df=self.df.drop(columns=to_drop), correlated_pairs=pairs)
+        fs.prune_nominals()
+        return fs
 
-    def prep_for_modeling(self, n_lags=None, reduce_collinearity=False):
+    def prep_for_modeling(self, n_lags=None, reduce_collinearity=False, encoding='dense'):
         print('Preparing feature set for modeling.')
     
         # One hot encode categoricals
-        self.one_hot_encode()
+        fs = self.one_hot_encode(encoding)
         
         if reduce_collinearity:
-            self.handle_multicollinearity()
+            fs = fs.handle_multicollinearity()
 
         # If this is a temporal fs
         if n_lags:
         
             # Get new, lagged featureset
-            fs = self.get_lagged_featureset(n_lags)
-        else:
-            fs = self
+            fs = fs.get_lagged_featureset(n_lags)
 
         # Should have already been done - this is just a safeguard
         fs.prune_nominals()
 
         # Ensure target column is last
         if fs.target_col:
-            end_col = fs.df.pop(fs.target_col)
-            fs.df[fs.target_col] = end_col
+            fs.df = fs.df[[col for col in fs.df.columns if col != fs.target_col] + [fs.target_col]]
 
         assert not fs.df.isnull().values.any(), 'featureset contains NaNs'
         return fs
 
+    @memoized_stage
+    def prep_lag_matrix(self, max_lags, reduce_collinearity=False, encoding='dense'):
+        '''
+            Same as prep_for_modeling, but for sweeping n_lags - the encoding is done once, and
+            the returned LagMatrix presents any n_lags <= max_lags as a Featureset
+
+            Args:
+                max_lags: Largest number of lags that will be requested
+                reduce_collinearity (optional): Drop highly correlated features first
+                encoding (optional): How to store the dummy columns (see ENCODINGS)
+
+            Returns:
+                A LagMatrix object
+        '''
+        from .lags import LagMatrix
+
+        print('Preparing lag matrix for modeling.')
+        fs = self.one_hot_encode(encoding)
+
+        if reduce_collinearity:
+            fs = fs.handle_multicollinearity()
+
+        return LagMatrix(fs, max_lags)
+
+    def update_participants(self, df, ids):
+        '''
+            Replace the rows of the given participants with freshly computed ones (e.g., after
+            appending new events), leaving everyone else untouched
+
+            Args:
+                df: A DataFrame with the same columns as self.df, holding the new rows
+                ids: The participants whose rows should be replaced
+
+            Returns:
+                A new Featureset, sorted by id and horizon
+        '''
+        keep = self.df[~self.df[self.id_col].isin(ids)]
+        res = pd.concat([keep, df[self.df.columns]], ignore_index=True)
+
+        sort_cols = [self.id_col] + ([self.horizon] if self.horizon in res.columns else [])
+        res = res.sort_values(by=sort_cols, kind='stable').reset_index(drop=True)
+
+        return Featureset(df=res, name=self.name, id_col=self.id_col, nominal_cols=self.nominal_cols,
+                          target_col=self.target_col, horizon=self.horizon, n_lags=self.n_lags,
+                          category_map=self.category_map)
+
     def __repr__(self):    
         rep = '\n'.join([
             f'Name: { self.name }',
@@ -206,3 +335,113 @@ def series_to_supervised(df, time_col, target_col, n_in=1, n_out=1, dropnan=True
 
              
              
+
+
+def lag_features(df, id_col, time_col, target_col, n_lags):
+    '''
+        Vectorized, all-subjects-at-once version of calling series_to_supervised(n_out=1) per subject
+
+        Rows are stably sorted by subject (in order of first appearance) and time, and each lag is
+        a single positional take - only the columns that series_to_supervised would keep are built.
+        Column names, column order and dropped rows are the same: a row is dropped if it has fewer
+        than n_lags earlier rows for its subject, or if any value in its window is missing.
+        Lagged columns keep their original dtypes.
+
+        Args:
+            df: A pandas DataFrame with one row per subject and time step
+            id_col: Name of column that stores a subject's unique identifier
+            time_col: Name of the horizon column (e.g., 'study_week') - its lags are dropped
+            target_col: Name of target var we want to predict later
+            n_lags: Number of lag observations as input
+
+        Returns:
+            A pandas DataFrame with the id column first and a fresh index
+    '''
+    # Stable sort by subject (first appearance order) and time
+    subjects = pd.factorize(df[id_col])[0]
+    order = np.lexsort((df[time_col].to_numpy(), subjects))
+    values = df.drop(columns=id_col).iloc[order].reset_index(drop=True)
+    subjects = subjects[order]
+
+    # Position of each row within its subject
+    starts = np.flatnonzero(np.r_[True, subjects[1:] != subjects[:-1]])
+    pos = np.arange(len(values)) - np.repeat(starts, np.diff(np.r_[starts, len(values)]))
+
+    # Number of rows with any missing value in each row's window (itself plus n_lags before it)
+    n_missing = np.r_[0, np.cumsum(values.isna().any(axis=1).to_numpy())]
+    window = n_missing[np.arange(len(values)) + 1] - n_missing[np.maximum(np.arange(len(values)) - n_lags, 0)]
+    keep = np.flatnonzero((pos >= n_lags) & (window == 0))
+
+    # Same naming and filtering rules as series_to_supervised
+    def kept(name, lagged):
+        return time_col not in name and (lagged or target_col in name)
+
+    blocks = []
+    for i in list(range(n_lags, 0, -1)) + [0]:
+        suffix = ' (t-%d)' % i if i else ' (t)'
+        cols = [col for col in values.columns if kept(col + suffix, i > 0)]
+
+        # take can widen sparse dtypes, so cast back
+        block = values[cols].take(keep - i).astype(values[cols].dtypes.to_dict(), copy=False)
+        block.columns = [col + suffix for col in cols]
+        blocks.append(block.reset_index(drop=True))
+
+    res = pd.concat(blocks, axis=1)
+
+    # drop the (t) suffix in the target column
+    res.rename(columns={target_col + ' (t)': target_col}, inplace=True)
+    res.insert(0, id_col, df[id_col].to_numpy()[order][keep])
+    return res
+
+def get_category_map(df, cols):
+    ''' Map each dummy column name (as pd.get_dummies would name it) to its (column, category) '''
+    return {'%s_%s' % (col, category): (col, category)
+            for col in cols for category in df[col].cat.categories}
+
+def encode_dummies(df, cols, sparse=False, dtype=np.int8):
+    '''
+        One-hot encode categorical columns straight from their codes, as compact int8 columns
+
+        Columns are named and ordered as with pd.get_dummies (other columns first, then one
+        dummy per category, in category order). Missing values get all zeros.
+
+        Args:
+            df: A pandas DataFrame
+            cols: Categorical columns to encode
+            sparse: If True, store the dummies as sparse arrays (only the ones are stored)
+            dtype: Integer dtype of the dummies
+
+        Returns:
+            A tuple of (encoded DataFrame, list of dummy column names)
+    '''
+    dummies = {}
+    for col in cols:
+        codes = df[col].cat.codes.to_numpy()
+        for i, category in enumerate(df[col].cat.categories):
+            values = (codes == i).astype(dtype)
+            dummies['%s_%s' % (col, category)] = pd.arrays.SparseArray(values, fill_value=0) if sparse else values
+
+    res = pd.concat([df.drop(columns=cols), pd.DataFrame(dummies, index=df.index)], axis=1)
+    return res, list(dummies)
+
+def compact_binary(df, cols, sparse=False, dtype=np.int8):
+    ''' Store the given columns as (sparse) int8 if they only hold 0s and 1s '''
+    df = df.copy()
+    for col in cols:
+        if col not in df.columns or isinstance(df[col].dtype, pd.SparseDtype):
+            continue
+
+        values = df[col].to_numpy()
+        if values.dtype.kind in 'biuf' and np.isin(values, [0, 1]).all():
+            values = values.astype(dtype)
+            df[col] = pd.arrays.SparseArray(values, fill_value=0) if sparse else values
+    return df
+
+def lag_category_map(category_map, columns):
+    ''' Carry a category map over to lagged column names (e.g., 'col_cat (t-2)') '''
+    res = {}
+    for col in columns:
+        base = col.rsplit(' (t', 1)[0]
+        if base in category_map:
+            res[col] = category_map[base]
+    return res
@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+
+from ..consts import DAYS_IN_WEEK, DAYS_IN_MONTH, TARGET_HORIZONS, TIME_OF_DAY_PROPS
+from .extract import segment_temporal_metrics, group_code_counts, group_mode
+from .featureset import Featureset
+
+# Number of days in each horizon coarser than a day
+HORIZON_DAYS = {
+    'study_week': DAYS_IN_WEEK,
+    'study_month': DAYS_IN_MONTH
+}
+
+def rollup_daily(events, id_col='PtID'):
+    '''
+        Aggregate events to one row per participant and study day - every horizon is derived from this
+
+        Args:
+            events: Long-form event DataFrame, with the columns added by get_temporal_feats
+
+            id_col: Name of column that stores a participant's unique identifier
+
+        Returns:
+            A tuple of (daily DataFrame sorted by id and study day, array mapping each event to its
+            row in the daily DataFrame (-1 for events without a day))
+    '''
+    grouped = events.groupby([id_col, 'study_day'], sort=True, observed=True)
+    day_codes = grouped.ngroup().fillna(-1).to_numpy().astype(np.int64)
+
+    daily = grouped.agg(
+        n_events=('num_times_used_today', 'sum'),
+        is_weekday=('is_weekday', 'first'),
+        day_of_week=('day_of_week', 'first'),
+        withinrange=('withinrange', 'max')
+    ).reset_index()
+
+    return daily, day_codes
+
+def _horizon_codes(daily, id_col, horizon_days):
+    ''' Assign each (sorted) day to its horizon bucket - buckets are contiguous, so no groupby is needed '''
+    ids = daily[id_col].to_numpy()
+    buckets = daily['study_day'].to_numpy() // horizon_days
+
+    is_new = np.ones(len(daily), dtype=bool)
+    is_new[1:] = (ids[1:] != ids[:-1]) | (buckets[1:] != buckets[:-1])
+    return np.cumsum(is_new) - 1, is_new, buckets
+
+def _build_temporal_frames(events, horizons, id_col, time_of_day_labels):
+    ''' Build each horizon's feature DataFrame and list of nominal columns '''
+    daily, day_codes = rollup_daily(events, id_col)
+    timestamps = events['datetime'].to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+    # Time of day as integer codes, in label order (-1 for events without a time)
+    n_tod = len(time_of_day_labels)
+    tod = events['time_of_day'].cat.set_categories(time_of_day_labels)
+    tod_dtype = tod.dtype
+    tod = tod.cat.codes.to_numpy().astype(np.int64)
+
+    frames = {}
+    for horizon in horizons:
+        nominal_cols = []
+
+        if horizon == 'study_day':
+            df = daily[[id_col, 'study_day', 'n_events', 'is_weekday', 'day_of_week']].copy()
+
+            # Add columns indicating if the MEMS cap was used during a given time(s) of day
+            # Basically a manual one-hot encoding while we're here
+            present = group_code_counts(day_codes, tod, len(daily), n_tod) > 0
+            for i, label in enumerate(time_of_day_labels):
+                df['time_of_day_' + label] = present[:, i].astype(float)
+                nominal_cols.append('time_of_day_' + label)
+
+            df['adherence_rate'] = daily['withinrange'].to_numpy()
+
+        else:
+            denom = HORIZON_DAYS[horizon]
+            codes, is_new, buckets = _horizon_codes(daily, id_col, denom)
+            n_groups = int(is_new.sum())
+
+            df = pd.DataFrame({id_col: daily[id_col].to_numpy()[is_new], horizon: buckets[is_new]})
+            df['n_events'] = np.bincount(codes, weights=daily['n_events'], minlength=n_groups).astype(
+                daily['n_events'].dtype)
+
+            # Get standard temporal metrics, mapping each event to its horizon through its day
+            event_codes = np.where(day_codes >= 0, codes[day_codes], -1)
+            for name, values in segment_temporal_metrics(event_codes, n_groups, timestamps).items():
+                df[name] = np.nan_to_num(values, nan=0.0)
+
+            # Calculate avg number of times used per day
+            df['num_daily_events_mean'] = df['n_events'] / denom
+
+            # Get most common time of day of event occurrence
+            mode_codes = group_mode(event_codes, tod, n_groups, n_tod)
+
+            # Same dtype as the events' time_of_day (all labels, in order), whichever were observed - so
+            # we can later select and one-hot encode, and shards agree on the dtype. Code -1 is NaN.
+            df['event_time_of_day_mode'] = pd.Categorical.from_codes(mode_codes, dtype=tod_dtype)
+
+            # Adherence rate is the share of days with an in-range dose (max per day will be 1 or 0)
+            df['adherence_rate'] = np.bincount(codes, weights=daily['withinrange'], minlength=n_groups) / denom
+
+        frames[horizon] = (df, nominal_cols)
+    return frames
+
+def build_temporal_featuresets(events, horizons=TARGET_HORIZONS, id_col='PtID',
+                               time_of_day_labels=TIME_OF_DAY_PROPS['labels']):
+    '''
+        Build one temporal Featureset per horizon, from a single daily rollup of the events
+
+        Week and month features are aggregated from the daily rollup (and the events' day codes),
+        so no per-horizon merges are needed and adding a horizon is cheap.
+
+        Args:
+            events: Long-form event DataFrame, with the columns added by get_temporal_feats
+
+            horizons: List of horizons (e.g., consts.TARGET_HORIZONS)
+
+            id_col: Name of column that stores a participant's unique identifier
+
+            time_of_day_labels: Labels of the time of day categories
+
+        Returns:
+            A list of Featureset objects, in the same order as horizons
+    '''
+    frames = _build_temporal_frames(events, horizons, id_col, time_of_day_labels)
+
+    return [Featureset(df=df, name=horizon, # Intentional for now - using horizon as name
+                       id_col=id_col, horizon=horizon, nominal_cols=nominal_cols)
+            for horizon, (df, nominal_cols) in frames.items()]
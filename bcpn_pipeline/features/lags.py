@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+from itertools import compress
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .featureset import Featureset, lag_category_map
+
+class LagMatrix:
+    '''
+        Lazy lagged view of a (one-hot encoded) temporal Featureset, for sweeping n_lags.
+
+        Rows are sorted by participant and horizon a single time, into one contiguous float array.
+        Any n_lags <= max_lags is then a sliding_window_view over that array (no copy) - only
+        the rows that survive the NaN-dropping are materialized, when the Featureset is built.
+        The output is the same as prep_for_modeling(n_lags) on the encoded Featureset.
+    '''
+    def __init__(self, fs, max_lags):
+        self.name = fs.name
+        self.id_col = fs.id_col
+        self.target_col = fs.target_col
+        self.horizon = fs.horizon
+        self.nominal_cols = list(fs.nominal_cols)
+        self.category_map = dict(fs.category_map)
+        self.max_lags = max_lags
+
+        # Stable sort by participant (first appearance order) and horizon, as in lag_features
+        subjects = pd.factorize(fs.df[self.id_col])[0]
+        order = np.lexsort((fs.df[self.horizon].to_numpy(), subjects))
+        values = fs.df.drop(columns=self.id_col).iloc[order]
+
+        self.ids = fs.df[self.id_col].to_numpy()[order]
+        self.columns = list(values.columns)
+        self.dtypes = values.dtypes
+        self.values = np.ascontiguousarray(values.to_numpy(dtype=float))
+
+        # Position of each row within its participant, and a running count of rows with a missing value
+        subjects = subjects[order]
+        starts = np.flatnonzero(np.r_[True, subjects[1:] != subjects[:-1]])
+        self.positions = np.arange(len(subjects)) - np.repeat(starts, np.diff(np.r_[starts, len(subjects)]))
+        self.n_missing = np.r_[0, np.cumsum(np.isnan(self.values).any(axis=1))]
+
+    def __len__(self):
+        return len(self.values)
+
+    def _rows(self, n_lags):
+        ''' Rows with n_lags earlier rows for the same participant and no missing values in the window '''
+        rows = np.arange(len(self))
+        window = self.n_missing[rows + 1] - self.n_missing[np.maximum(rows - n_lags, 0)]
+        return np.flatnonzero((self.positions >= n_lags) & (window == 0))
+
+    def featureset(self, n_lags):
+        '''
+            Present the lagged data for a given number of lags as a Featureset, ready for modeling
+
+            Args:
+                n_lags: Number of lag observations as input (at most max_lags)
+
+            Returns:
+                A Featureset with the lagged columns (col (t-k)), the target last and no NaNs
+        '''
+        if not 1 <= n_lags <= self.max_lags:
+            raise ValueError('n_lags must be between 1 and %d, got %s.' % (self.max_lags, n_lags))
+
+        rows = self._rows(n_lags)
+
+        # Same naming and filtering rules as series_to_supervised
+        lag_idx = [i for i, col in enumerate(self.columns) if self.horizon not in col + ' (t-1)']
+        now_idx = [i for i, col in enumerate(self.columns)
+                   if self.horizon not in col + ' (t)' and self.target_col in col + ' (t)']
+
+        # windows[r] holds rows r..r+n_lags, so the window ending at row i starts at i - n_lags
+        if len(rows):
+            windows = sliding_window_view(self.values, n_lags + 1, axis=0)[rows - n_lags]
+        else:
+            windows = np.empty((0, len(self.columns), n_lags + 1))
+
+        # Lag-major column order: every column at (t-n_lags), then at (t-n_lags+1), ...
+        lagged = windows[:, lag_idx, :n_lags].transpose(0, 2, 1).reshape(len(rows), n_lags * len(lag_idx))
+        data = np.concatenate([lagged, windows[:, now_idx, n_lags]], axis=1)
+
+        names = ['%s (t-%d)' % (self.columns[j], i) for i in range(n_lags, 0, -1) for j in lag_idx]
+        names += [self.columns[j] + ' (t)' for j in now_idx]
+        dtypes = {name: self.dtypes.iloc[j] for name, j in zip(names, lag_idx * n_lags + now_idx)}
+
+        df = pd.DataFrame(data, columns=names).astype(dtypes)
+        df.rename(columns={self.target_col + ' (t)': self.target_col}, inplace=True)
+        df.insert(0, self.id_col, self.ids[rows])
+
+        # Ensure target column is last
+        df[self.target_col] = df.pop(self.target_col)
+
+        # Get a new list of nominal feats that mirrors the lagged structure
+        mask = [any(col_og in col for col_og in self.nominal_cols) for col in df.columns]
+        nominal_cols = [col for col in compress(list(df.columns), mask)
+                        if col != self.id_col and col != self.target_col]
+
+        return Featureset(df=df, name=self.name, nominal_cols=nominal_cols,
+                          id_col=self.id_col, target_col=self.target_col, n_lags=n_lags,
+                          category_map=lag_category_map(self.category_map, df.columns))
+
+    def __iter__(self):
+        ''' Featuresets for 1 to max_lags lags '''
+        for n_lags in range(1, self.max_lags + 1):
+            yield self.featureset(n_lags)
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.ids.nbytes + self.positions.nbytes + self.n_missing.nbytes
+
+    def __repr__(self):
+        return '\n'.join([
+            f'Name: { self.name }',
+            f'Number of observations: {len(self)}',
+            f'Max number of lags: { self.max_lags }',
+            f'Memory: {self.nbytes / 1e6:.2f} MB'
+        ])
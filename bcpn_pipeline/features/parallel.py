@@ -0,0 +1,104 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from ..consts import TARGET_HORIZONS, TIME_OF_DAY_PROPS
+from ..data.store import concat_frames
+from .extract import get_temporal_feats
+from .featureset import Featureset
+from .horizons import _build_temporal_frames
+
+def shard_by_id(df, id_col='PtID', n_shards=1):
+    '''
+        Split a DataFrame into contiguous shards of whole participants, in sorted id order
+
+        Args:
+            df: A pandas DataFrame
+            id_col: Name of column that stores a participant's unique identifier
+            n_shards: Number of shards (capped at the number of participants)
+
+        Returns:
+            A list of DataFrames - concatenating them gives df sorted by id. An empty df is
+            returned as a single (empty) shard.
+    '''
+    df = df.sort_values(by=id_col, kind='stable')
+    ids = df[id_col].unique()
+    if not len(ids):
+        return [df]
+
+    n_shards = max(1, min(n_shards, len(ids)))
+
+    # Each shard starts at the first row of its first participant
+    first_ids = [chunk[0] for chunk in np.array_split(ids, n_shards)]
+    bounds = list(np.searchsorted(df[id_col].to_numpy(), first_ids)) + [len(df)]
+    return [df.iloc[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+def _temporal_frames_worker(events, horizons, start_date_col, id_col, time_of_day_props,
+                            add_temporal_feats, preprocess):
+    ''' Run the per-participant feature steps on one shard (module level, so it can be pickled) '''
+    if add_temporal_feats:
+        events = get_temporal_feats(events, start_date_col=start_date_col, id_col=id_col,
+                                    time_of_day_props=time_of_day_props, inplace=False)
+    if preprocess is not None:
+        events = preprocess(events)
+
+    return _build_temporal_frames(events, horizons, id_col, time_of_day_props['labels'])
+
+def build_temporal_featuresets_parallel(events, horizons=TARGET_HORIZONS, start_date_col='DateEnroll',
+                                        id_col='PtID', time_of_day_props=TIME_OF_DAY_PROPS,
+                                        add_temporal_feats=True, preprocess=None,
+                                        n_workers=None, shards_per_worker=4):
+    '''
+        Parallel version of build_temporal_featuresets - events are sharded by participant,
+        each shard is processed in a separate process, and the results are concatenated in
+        sorted id order, so the output matches the single-process build
+
+        Args:
+            events: Long-form event DataFrame (e.g., from data.melt_mems_events, with a datetime column)
+
+            horizons: List of horizons (e.g., consts.TARGET_HORIZONS)
+
+            start_date_col: Name of column that stores a participant's study start date
+
+            id_col: Name of column that stores a participant's unique identifier
+
+            time_of_day_props: Time of day bins and labels (e.g., consts.TIME_OF_DAY_PROPS)
+
+            add_temporal_feats: If True (the default), run get_temporal_feats on each shard first.
+                Set to False when events already have the temporal columns.
+
+            preprocess (optional): Function taking and returning a shard's events, run after
+                get_temporal_feats (e.g., washout filtering). Must only need one participant's
+                rows at a time, and must be picklable (i.e., defined at module level).
+
+            n_workers (optional): Number of worker processes. Defaults to the number of CPUs;
+                with 1 (or when there is only one shard), everything runs in this process.
+
+            shards_per_worker: Number of shards per worker - more, smaller shards balance the
+                load better across participants with very different numbers of events
+
+        Returns:
+            A list of Featureset objects, in the same order as horizons
+    '''
+    n_workers = n_workers or os.cpu_count() or 1
+    shards = shard_by_id(events, id_col, n_shards=n_workers * shards_per_worker)
+    args = (horizons, start_date_col, id_col, time_of_day_props, add_temporal_feats, preprocess)
+
+    # A single shard (e.g., no events at all) isn't worth starting processes for
+    if n_workers == 1 or len(shards) == 1:
+        results = [_temporal_frames_worker(shard, *args) for shard in shards]
+    else:
+        print('Building temporal features for %d shards on %d workers...' % (len(shards), n_workers))
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            # map keeps shard order, so the output is deterministic
+            results = list(executor.map(_temporal_frames_worker, shards, *[[arg] * len(shards) for arg in args]))
+
+    featuresets = []
+    for horizon in horizons:
+        frames = [res[horizon][0] for res in results]
+
+        # Shards that were filtered down to nothing would only upcast the dtypes
+        frames = [df for df in frames if len(df)] or frames[:1]
+        featuresets.append(Featureset(df=concat_frames(frames), name=horizon, # Using horizon as name, as before
+                                      id_col=id_col, horizon=horizon, nominal_cols=results[0][horizon][1]))
+    return featuresets
@@ -6,17 +6,18 @@ from sklearn.metrics import roc_curve, auc
 from xgboost import XGBClassifier
 import pandas as pd
 from ..consts import OUTPUT_PATH_LAGS, OUTPUT_PATH_PRED, OUTPUT_PATH_LMM
-from .predict import repeated_cross_validation, train_test
+from .predict import cross_validation_run, save_repeated_cv_results, train_test
 from .shap_only import predict as shap_only
 from .transform import impute
+from .resources import iter_parallel
+from .splits import get_splits
 from .metrics import calc_performance_metrics, get_mean_roc_auc
 # from .helpers import to_csv_async
-from sklearn.model_selection import StratifiedGroupKFold
 from pathlib import Path
 import joblib
 import json
 
-def tune_lags(fs):
+def tune_lags(fs, n_jobs=1):
 
     # Exclude first month (ramp-up period during which time users were getting used to the MEMS caps)
     if fs.horizon == 'study_day':
@@ -26,7 +27,7 @@ def tune_lags(fs):
     elif fs.horizon == 'study_month':
         exclusion_thresh = 1
 
-    fs.df = fs.df[fs.df[fs.horizon] > exclusion_thresh]
+    fs = fs.copy(df=fs.df[fs.df[fs.horizon] > exclusion_thresh])
 
     # Ensure we don't end up with a tiny feature set!
     if fs.horizon == 'study_month':
@@ -34,24 +35,26 @@ def tune_lags(fs):
     else:
         lag_range = range(1, 8)
 
-    for n_lags in lag_range:
-        print('For ' + str(n_lags) + ' lags.')
+    #Perform final encoding, scaling, etc - once for the whole sweep
+    lag_matrix = fs.prep_lag_matrix(max(lag_range))
 
-        #Perform final encoding, scaling, etc
-        all_feats = fs.prep_for_modeling(n_lags)
+    # Every (n_lags, max_depth) pair is an independent experiment - run them all on one worker pool
+    experiments = []
+    for n_lags in lag_range:
+        all_feats = lag_matrix.featureset(n_lags)
 
         # Also tune the tree depth - will help us with gridsearch later on
         for max_depth in range(1, 6):
-            print('Using tree with max_depth of %i.' % (max_depth))
             models = {
                 'RF': RandomForestClassifier(max_depth=max_depth, random_state=max_depth)
             }
 
-            kwargs = {'models': models, 'max_depth': max_depth}
-
             # Pass in max_depth so it gets recorded...dont' ask me why I designed it this way.
-            predict_from_mems(fs=all_feats, tune=False, output_path=OUTPUT_PATH_LAGS,
-                              select_feats=False, importance=False, repeated_cv=True, **kwargs)
+            experiments.append({'fs': all_feats, 'tune': False, 'output_path': OUTPUT_PATH_LAGS,
+                                'select_feats': False, 'importance': False, 'repeated_cv': True,
+                                'models': models, 'max_depth': max_depth})
+
+    run_experiments(experiments, n_jobs=n_jobs)
 
 
 def get_default_clf(method, common_fields, max_depth, random_state):
@@ -84,8 +87,23 @@ def get_default_clf(method, common_fields, max_depth, random_state):
     return clf, common_fields
 
 
-def predict_from_mems(fs, tune, select_feats, output_path=OUTPUT_PATH_PRED, importance=True, repeated_cv=True, **kwargs):
+def predict_from_mems(fs, tune, select_feats, output_path=OUTPUT_PATH_PRED, importance=True, repeated_cv=True,
+                      n_jobs=1, **kwargs):
+    '''
+        Cross-validate each method (repeated_cv) and build a final model per method
 
+        With n_jobs != 1, the runs and methods are scheduled on a worker pool (see run_experiments),
+        and a RuntimeError listing the failed tasks is raised once the others are done
+    '''
+    run_experiments([dict(fs=fs, tune=tune, select_feats=select_feats, output_path=output_path,
+                          importance=importance, repeated_cv=repeated_cv, **kwargs)], n_jobs=n_jobs)
+
+
+def plan_experiment(fs, tune, select_feats, output_path=OUTPUT_PATH_PRED, importance=True, repeated_cv=True, **kwargs):
+    '''
+        Expand one predict_from_mems call into one spec per method - with the same classifiers,
+        filenames and recorded fields as running the methods one after another
+    '''
     common_fields = {'n_lags': fs.n_lags, 'featureset': fs.name, 'features_selected': select_feats,
                      'tuned': tune, 'target': fs.target_col}
 
@@ -103,6 +121,7 @@ def predict_from_mems(fs, tune, select_feats, output_path=OUTPUT_PATH_PRED, impo
     models = dict.fromkeys(
         ['LogisticR', 'RF', 'XGB', 'SVM']) if not models else models
 
+    specs = []
     for method, clf in models.items():
         if clf is None:
             clf, common_fields = get_default_clf(
@@ -125,60 +144,148 @@ def predict_from_mems(fs, tune, select_feats, output_path=OUTPUT_PATH_PRED, impo
         if tune:
             filename += '_tuned'
 
+        spec = {'X': X, 'y': y, 'id_col': fs.id_col, 'clf': clf, 'nominal_idx': nominal_idx,
+                'method': method, 'select_feats': select_feats, 'tune': tune, 'importance': importance,
+                'repeated_cv': repeated_cv, 'output_path': output_path, 'filename': filename,
+                'cv_fields': dict(common_fields)}
+
+        # Saving the repeated CV results marks the fields as aggregated, for every later method too
         if repeated_cv:
-            repeated_cross_validation(X, y, fs.id_col, clf, nominal_idx,
-                                    method, select_feats, tune, common_fields, output_path, filename)
+            common_fields.update({'run': -1})
 
-        filename = f'{filename}_final_clf'
+        spec['final_fields'] = dict(common_fields)
+        specs.append(spec)
 
-        # Build final model
-        splitter = StratifiedGroupKFold(n_splits=2, random_state=42, shuffle=True)
+    return specs
 
-        train_idx, test_idx = next(splitter.split(X, y, groups=X[fs.id_col]))
-        X_train, y_train = X.iloc[train_idx], y.iloc[train_idx]
-        X_test, y_test = X.iloc[test_idx], y.iloc[test_idx]
 
-        res, best_estimator = train_test(X_train, y_train, X_test, y_test, fs.id_col, clf,
-                                         42, nominal_idx, method, select_feats, tune, importance=importance)
-        
-        joblib.dump(best_estimator, output_path / f'{filename}.joblib', compress=1)
-        with open(output_path / f'{filename}_params.json', 'w') as f:
-            json.dump(best_estimator.get_params(), f)
+def train_final_clf(X, y, id_col, clf, nominal_idx, method, select_feats, tune, importance):
+    ''' Build the final model on a single subject-level split '''
+    train_idx, test_idx = get_splits(y, X[id_col], 42, n_splits=2)[0]
+    X_train, y_train = X.iloc[train_idx], y.iloc[train_idx]
+    X_test, y_test = X.iloc[test_idx], y.iloc[test_idx]
 
-        train_perf_metrics = calc_performance_metrics(
-            y_true=res['train_res']['y_true'], y_pred=res['train_res']['y_pred']
-        )
-        test_perf_metrics = calc_performance_metrics(
-            y_true=res['test_res']['y_true'], y_pred=res['test_res']['y_pred']
-        )
+    return train_test(X_train, y_train, X_test, y_test, id_col, clf,
+                      42, nominal_idx, method, select_feats, tune, importance=importance)
 
-        train_perf_metrics.update({'type': 'train'})
-        test_perf_metrics.update({'type': 'test'})
 
-        all_res = []
+def save_final_clf(res, best_estimator, X, method, common_fields, output_path, filename, importance):
+    ''' Write the final model, its parameters, performance, ROC and (optionally) SHAP values '''
+    filename = f'{filename}_final_clf'
 
-        for d in [train_perf_metrics, test_perf_metrics]:
-            d.update({'method': method, 'random_state': 42,
-                      'n_features': X.shape[1], 'n_samples': X.shape[0]})
-            d.update(common_fields)
-            all_res.append(pd.DataFrame([d]))
+    joblib.dump(best_estimator, output_path / f'{filename}.joblib', compress=1)
+    with open(output_path / f'{filename}_params.json', 'w') as f:
+        json.dump(best_estimator.get_params(), f)
 
-        pd.concat(all_res).to_csv(Path.joinpath(
-            output_path, f'{filename}_pred.csv'))
+    train_perf_metrics = calc_performance_metrics(
+        y_true=res['train_res']['y_true'], y_pred=res['train_res']['y_pred']
+    )
+    test_perf_metrics = calc_performance_metrics(
+        y_true=res['test_res']['y_true'], y_pred=res['test_res']['y_pred']
+    )
 
-        res['df_roc'].to_csv(
-            Path.joinpath(output_path, f'{filename}_roc.csv'))
+    train_perf_metrics.update({'type': 'train'})
+    test_perf_metrics.update({'type': 'test'})
 
-        if not importance:
-            continue
+    all_res = []
+
+    for d in [train_perf_metrics, test_perf_metrics]:
+        d.update({'method': method, 'random_state': 42,
+                  'n_features': X.shape[1], 'n_samples': X.shape[0]})
+        d.update(common_fields)
+        all_res.append(pd.DataFrame([d]))
+
+    pd.concat(all_res).to_csv(Path.joinpath(
+        output_path, f'{filename}_pred.csv'))
+
+    res['df_roc'].to_csv(
+        Path.joinpath(output_path, f'{filename}_roc.csv'))
+
+    if not importance:
+        return
+
+    (feats, explainer, shap_values) = res['shap_tuple']
+
+    with open(Path.joinpath(output_path, f'feats_{filename}.pkl'), 'wb') as fp:
+        pickle.dump(feats, fp)
 
-        (feats, explainer, shap_values) = res['shap_tuple']
+        with open(Path.joinpath(output_path, f'shap_explainer_{filename}.pkl'), 'wb') as fp:
+            pickle.dump(explainer, fp)
 
-        with open(Path.joinpath(output_path, f'feats_{filename}.pkl'), 'wb') as fp:
-            pickle.dump(feats, fp)
+        with open(Path.joinpath(output_path, f'shap_values_{filename}.pkl'), 'wb') as fp:
+            pickle.dump(shap_values, fp)
 
-            with open(Path.joinpath(output_path, f'shap_explainer_{filename}.pkl'), 'wb') as fp:
-                pickle.dump(explainer, fp)
 
-            with open(Path.joinpath(output_path, f'shap_values_{filename}.pkl'), 'wb') as fp:
-                pickle.dump(shap_values, fp)
+def _run_task(kind, spec, run=None, run_repeats=None):
+    ''' Run one scheduled task: a repeated CV run, or the final model (module level, so it can be run in a worker) '''
+    args = [spec[k] for k in ['X', 'y', 'id_col', 'clf', 'nominal_idx', 'method', 'select_feats', 'tune']]
+    if kind == 'cv':
+        return cross_validation_run(*args, run, run_repeats)
+    return train_final_clf(*args, spec['importance'])
+
+
+def run_experiments(experiments, n_jobs=1, run_repeats=5):
+    '''
+        Experiment-level scheduler: expands experiments x methods x runs into independent tasks,
+        runs them on a worker pool (joblib's loky backend), and writes the same CSV (and model)
+        outputs as calling predict_from_mems once per experiment
+
+        Each model's outputs are written as soon as its tasks are done - its repeated CV results
+        once all of its runs have finished, its final model right away - so a failed or killed
+        sweep keeps everything finished so far. In this process (n_jobs=1), a failing task raises
+        right away, as before. On a worker pool, the other tasks keep running and their outputs
+        are written, and a RuntimeError listing the failed tasks is raised at the end.
+
+        Args:
+            experiments: List of dictionaries of predict_from_mems arguments (fs, tune, select_feats,
+                output_path, importance, repeated_cv, plus any fields to record, e.g. models or max_depth)
+
+            n_jobs: Number of worker processes (-1 for all cores), capped by the CPU budget. With 1,
+                tasks run in this process, in the same order as before.
+
+            run_repeats: Number of repeated cross-validation runs per method
+    '''
+    specs = [spec for experiment in experiments for spec in plan_experiment(**experiment)]
+
+    tasks = []
+    for i, spec in enumerate(specs):
+        if spec['repeated_cv']:
+            tasks += [(i, 'cv', run) for run in range(run_repeats)]
+        tasks.append((i, 'final', None))
+
+    print('Running %d tasks for %d models.' % (len(tasks), len(specs)))
+    results = iter_parallel(_run_task, [(kind, specs[i], run, run_repeats) for i, kind, run in tasks],
+                            n_jobs=n_jobs)
+
+    # Runs of each model's repeated CV, collected until all of them are done
+    run_res = {i: {} for i, spec in enumerate(specs) if spec['repeated_cv']}
+    failed = []
+
+    for t, res, error in results:
+        i, kind, run = tasks[t]
+        spec = specs[i]
+
+        if error is not None:
+            print('%s failed (%s): %r' % (spec['filename'], 'CV run %d' % run if kind == 'cv' else 'final model', error))
+            failed.append((spec['filename'], kind, run, error))
+
+            # Without all of its runs, the model's repeated CV results can't be saved
+            if kind == 'cv':
+                run_res.pop(i, None)
+            continue
+
+        if kind == 'final':
+            res, best_estimator = res
+            save_final_clf(res, best_estimator, spec['X'], spec['method'], spec['final_fields'],
+                           spec['output_path'], spec['filename'], spec['importance'])
+
+        elif i in run_res:
+            run_res[i][run] = res
+            if len(run_res[i]) == run_repeats:
+                save_repeated_cv_results([run_res[i][run] for run in range(run_repeats)], spec['X'],
+                                         spec['method'], spec['cv_fields'], spec['output_path'], spec['filename'])
+                del run_res[i]
+
+    if failed:
+        raise RuntimeError('%d of %d tasks failed: %s' % (len(failed), len(tasks), [
+            (filename, kind, run) for filename, kind, run, _ in failed])) from failed[0][3]
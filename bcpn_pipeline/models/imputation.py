@@ -0,0 +1,135 @@
+import collections
+import hashlib
+import os
+from pathlib import Path
+import joblib
+import pandas as pd
+from sklearn.experimental import enable_iterative_imputer
+from sklearn.impute import IterativeImputer
+from . import transform
+from .resources import share_with_workers
+
+# Memory limit of the imputed fold matrices kept in this process - workers each get an equal share
+IMPUTER_CACHE_BYTES = 512 * 1024 ** 2
+_imputer_cache = collections.OrderedDict()
+_cache_bytes = 0
+
+# Optional directory that every fitted fold is also written to, and shared with other workers through
+_spill_dir = None
+
+def set_imputer_cache(max_bytes=None, spill_dir=None):
+    '''
+        Configure the imputer cache - in this process, and in the workers of run_parallel/iter_parallel,
+        which split max_bytes evenly between them (so a pool stays within the same memory limit)
+
+        The spill directory belongs to the caller: the cache writes one <key>.joblib file per fold
+        into it and never deletes them by itself (entries are keyed by content, so they stay valid).
+        Use clear_imputer_cache(spilled=True), or remove the directory, once the sweep is done.
+
+        Args:
+            max_bytes: Memory limit of the cache, in bytes (0 disables caching in memory)
+            spill_dir: Directory to write fitted folds to (and to read other workers' folds from),
+                or None to keep them in memory only
+    '''
+    global IMPUTER_CACHE_BYTES, _spill_dir
+    if max_bytes is not None:
+        IMPUTER_CACHE_BYTES = max_bytes
+    _spill_dir = Path(spill_dir) if spill_dir else None
+    _evict()
+
+def get_imputer_cache():
+    ''' Current configuration, as set_imputer_cache arguments '''
+    return IMPUTER_CACHE_BYTES, _spill_dir
+
+def split_imputer_cache(settings, n_workers):
+    ''' Each worker's share of the configuration: an equal part of the memory limit, the same spill directory '''
+    max_bytes, spill_dir = settings
+    return max_bytes // n_workers, spill_dir
+
+share_with_workers('imputer_cache', get_imputer_cache, set_imputer_cache, split=split_imputer_cache)
+
+def clear_imputer_cache(spilled=False):
+    ''' Empty the in-memory cache - and, if spilled, delete the folds written to the spill directory '''
+    global _cache_bytes
+    _imputer_cache.clear()
+    _cache_bytes = 0
+
+    if spilled and _spill_dir is not None and _spill_dir.exists():
+        for path in _spill_dir.glob('*.joblib'):
+            path.unlink()
+
+def imputer_key(X_train, X_test, random_state):
+    ''' Content hash of the fold: columns, values and row indices of both matrices, plus the seed '''
+    h = hashlib.sha1()
+    for df in [X_train, X_test]:
+        h.update(repr(list(df.columns)).encode())
+        h.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    h.update(repr(random_state).encode())
+    return h.hexdigest()
+
+def _nbytes(entry):
+    X_train, X_test, _ = entry
+    return int(X_train.memory_usage(deep=True).sum() + X_test.memory_usage(deep=True).sum())
+
+def _evict():
+    global _cache_bytes
+    while _imputer_cache and _cache_bytes > IMPUTER_CACHE_BYTES:
+        _, entry = _imputer_cache.popitem(last=False)
+        _cache_bytes -= _nbytes(entry)
+
+def _store(key, entry):
+    global _cache_bytes
+    _imputer_cache[key] = entry
+    _cache_bytes += _nbytes(entry)
+    _evict()
+
+def _spill(key, entry):
+    ''' Write an entry under a temporary name, then move it into place - readers never see a partial file '''
+    _spill_dir.mkdir(parents=True, exist_ok=True)
+    tmp = _spill_dir / f'{key}.{os.getpid()}.tmp'
+    joblib.dump(entry, tmp)
+    os.replace(tmp, _spill_dir / f'{key}.joblib')
+
+def _load(key):
+    if key in _imputer_cache:
+        _imputer_cache.move_to_end(key)
+        return _imputer_cache[key]
+
+    if _spill_dir is not None and (_spill_dir / f'{key}.joblib').exists():
+        entry = joblib.load(_spill_dir / f'{key}.joblib')
+        _store(key, entry)
+        return entry
+
+    return None
+
+def impute_fold(X_train, X_test, random_state):
+    '''
+        Fit an IterativeImputer on the fold's training rows and impute both matrices - or reuse the
+        result of an earlier call on the same fold. Imputation doesn't depend on the classifier, so
+        every method (and depth, and tuning setting) cross-validated on a fold shares one fit.
+
+        Args:
+            X_train: Dense training matrix of the fold
+            X_test: Dense test matrix of the fold
+            random_state: Seed of the imputer
+
+        Returns:
+            A tuple of (imputed X_train, imputed X_test, fitted imputer) - the matrices are copies
+            the caller may modify
+    '''
+    key = imputer_key(X_train, X_test, random_state)
+    entry = _load(key)
+
+    if entry is None:
+        imputer = IterativeImputer(random_state=random_state)
+        imputer.fit(X_train)
+        entry = (transform.impute(X_train.copy(), imputer), transform.impute(X_test.copy(), imputer), imputer)
+        _store(key, entry)
+
+        if _spill_dir is not None:
+            _spill(key, entry)
+    else:
+        print('Reusing imputed fold.')
+
+    X_train, X_test, imputer = entry
+    return X_train.copy(), X_test.copy(), imputer
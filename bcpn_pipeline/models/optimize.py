@@ -1,11 +1,13 @@
 from xgboost import XGBClassifier
-from sklearn.model_selection import StratifiedGroupKFold
 from sklearn.linear_model import LogisticRegression
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.svm import SVC
 from sklearn.metrics import roc_curve, auc, recall_score, make_scorer
 from tune_sklearn import TuneGridSearchCV
 
+from .resources import thread_budget
+from .splits import get_splits
+
 # Thank you to Lee Cai, who bootstrapped a similar function in a diff project
 # Modifications have been made to suit this project.
 def tune_hyperparams(X, y, groups, method, random_state):
@@ -61,9 +63,12 @@ def tune_hyperparams(X, y, groups, method, random_state):
         
         model = SVC(probability=True, random_state=random_state)
 
+    # Stay within this process' share of the CPU budget (e.g., when running as a fold worker)
+    n_jobs = min(n_jobs, thread_budget())
     print('n_jobs = ' + str(n_jobs))
 
-    cv = StratifiedGroupKFold(n_splits=5, shuffle=True, random_state=random_state)
+    # Inner folds - precomputed (and cached) so trials don't rebuild the splitter
+    cv = get_splits(y, groups, random_state, n_splits=5)
 
     # Create custom scorer for specificity
     scorer = make_scorer(recall_score, pos_label=0)
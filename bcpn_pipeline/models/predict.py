@@ -7,16 +7,17 @@ from scipy import interp
 from sklearn.ensemble import RandomForestClassifier
 
 from sklearn.metrics import roc_curve, auc
-from sklearn.experimental import enable_iterative_imputer
-from sklearn.impute import IterativeImputer
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.feature_selection import SelectFromModel
-from sklearn.model_selection import StratifiedGroupKFold
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import roc_curve, auc
+from sklearn.base import clone
 
 from ..consts import FPR_MEAN
+from . import imputation
 from . import optimize
+from . import resources
+from . import splits
 from . import transform
 from .metrics import calc_performance_metrics, get_mean_roc_auc, calc_shap
 
@@ -24,11 +25,12 @@ from .metrics import calc_performance_metrics, get_mean_roc_auc, calc_shap
 def train_test(X_train, y_train, X_test, y_test, id_col, clf, random_state, nominal_idx,
                method, select_feats, tune, importance):
 
-    # Do imputation
-    imputer = IterativeImputer(random_state=random_state)
-    imputer.fit(X_train)
-    X_train = transform.impute(X_train, imputer)
-    X_test = transform.impute(X_test, imputer)
+    # Imputation and upsampling need dense inputs
+    X_train = transform.densify(X_train)
+    X_test = transform.densify(X_test)
+
+    # Do imputation - fits are cached per fold, so other methods on the same fold reuse them
+    X_train, X_test, imputer = imputation.impute_fold(X_train, X_test, random_state)
 
     # Perform upsampling to handle class imbalance
     if nominal_idx:
@@ -123,8 +125,29 @@ def train_test(X_train, y_train, X_test, y_test, id_col, clf, random_state, nomi
     return res, clf
 
 
+def _train_test_fold(X, y, train_index, test_index, id_col, clf, random_state, nominal_idx,
+                     method, select_feats, tune):
+    ''' Train and test on one fold, with a fresh clone of clf (module level, so it can be run in a worker) '''
+    X_train, y_train = X.loc[train_index, :], y[train_index]
+    X_test, y_test = X.loc[test_index, :], y[test_index]
+
+    res, _ = train_test(X_train=X_train, X_test=X_test, y_train=y_train, y_test=y_test,
+                        id_col=id_col, clf=clone(clf), random_state=random_state,
+                        nominal_idx=nominal_idx, method=method, select_feats=select_feats,
+                        tune=tune, importance=False)
+    return res
+
+
 def cross_validate(X, y, id_col, clf, random_state, nominal_idx, method, select_feats,
-                   tune):
+                   tune, n_jobs=1):
+    '''
+        Subject-level stratified 5-fold cross-validation
+
+        With n_jobs > 1 (or -1 for all cores), folds run concurrently in worker processes (joblib's
+        loky backend), sized by the CPU budget (see resources). Every fold gets its own clone of clf
+        and the same random_state as in a serial run, and results are collected in fold order - so
+        the output is identical to n_jobs=1.
+    '''
 
     res_all = {
         'tpr': [],  # Array of true positive rates
@@ -137,20 +160,16 @@ def cross_validate(X, y, id_col, clf, random_state, nominal_idx, method, select_
     ''' Need to be splitting at the subject level
         Thank you, Koesmahargyo et al.! '''
 
-    cv = StratifiedGroupKFold(n_splits=5, shuffle=True,
-                              random_state=random_state)
+    # Splits are cached, so every method and depth sees the same folds for a given run
+    folds = splits.get_splits(y, X[id_col], random_state, n_splits=5)
 
-    # Do prediction task
-    for train_index, test_index in cv.split(X=X, y=y, groups=X[id_col]):
-        X_train, y_train = X.loc[train_index, :], y[train_index]
-        X_test, y_test = X.loc[test_index, :], y[test_index]
+    # Do prediction task - training and testing on each fold
+    fold_args = (id_col, clf, random_state, nominal_idx, method, select_feats, tune)
 
-        # Do training and testing
-        res, _ = train_test(X_train=X_train, X_test=X_test, y_train=y_train, y_test=y_test,
-                            id_col=id_col, clf=clf, random_state=random_state,
-                            nominal_idx=nominal_idx, method=method, select_feats=select_feats,
-                            tune=tune, importance=False)
+    fold_res = resources.run_parallel(_train_test_fold, [(X, y, train_index, test_index) + fold_args
+                                                         for train_index, test_index in folds], n_jobs=n_jobs)
 
+    for res in fold_res:
         for k, v in res.items():
             if k in res_all.keys():
                 res_all[k].append(v)
@@ -178,24 +197,44 @@ def cross_validate(X, y, id_col, clf, random_state, nominal_idx, method, select_
 
 def repeated_cross_validation(X, y, id_col, clf, nominal_idx, method, select_feats, tune,
                               common_fields, output_path, filename,
-                              run_repeats=5):
+                              run_repeats=5, n_jobs=1):
+
+    run_res = []
+
+    # Do repeated runs
+    for run in range(0, run_repeats):
+        run_res.append(cross_validation_run(X, y, id_col, clf, nominal_idx, method, select_feats,
+                                            tune, run, run_repeats, n_jobs=n_jobs))
+
+    save_repeated_cv_results(run_res, X, method, common_fields, output_path, filename)
 
+
+def cross_validation_run(X, y, id_col, clf, nominal_idx, method, select_feats, tune, run,
+                         run_repeats, n_jobs=1):
+    ''' One run of repeated_cross_validation (the run number is the random state) '''
+    print('Run %i of %i for %s model.' %
+          (run + 1, run_repeats, method))
+
+    res = cross_validate(X, y, id_col, clf, run, nominal_idx, method,
+                         select_feats, tune, n_jobs=n_jobs)
+
+    print('Prediction task complete!')
+    return res
+
+
+def save_repeated_cv_results(run_res, X, method, common_fields, output_path, filename):
+    ''' Write the per-run metrics and the aggregate ROC and AUC of repeated_cross_validation '''
     tpr = []  # Array of true positive rates
     auc = []  # Array of AUC scores
 
     all_res = []
 
-    # Do repeated runs
-    for run in range(0, run_repeats):
-        print('Run %i of %i for %s model.' %
-              (run + 1, run_repeats, method))
+    for run, res in enumerate(run_res):
         random_state = run
 
-        res = cross_validate(X, y, id_col, clf, random_state, nominal_idx, method,
-                             select_feats, tune)
-
         # Get train and test results as separate dictionaries
         for d in [res['train_perf_metrics'], res['test_perf_metrics']]:
+            d = dict(d)
             d.update({'method': method, 'run': run, 'random_state': random_state,
                       'n_features': X.shape[1], 'n_samples': X.shape[0]})
             d.update(common_fields)
@@ -205,8 +244,6 @@ def repeated_cross_validation(X, y, id_col, clf, nominal_idx, method, select_fea
         tpr.extend(res['tpr'])
         auc.extend(res['auc'])
 
-        print('Prediction task complete!')
-
     print('Saving performance metrics for all runs.')
 
     pd.concat(all_res).to_csv(Path.joinpath(
@@ -0,0 +1,161 @@
+import os
+from concurrent.futures import as_completed
+from contextlib import contextmanager
+from joblib.externals.loky import get_reusable_executor
+from threadpoolctl import threadpool_limits
+
+# Environment variables that size BLAS/OpenMP (and numexpr, numba) thread pools when a worker starts
+THREAD_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS',
+               'VECLIB_MAXIMUM_THREADS', 'NUMBA_NUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+def available_cpus():
+    ''' Number of cores this process may run on (respects CPU affinity, e.g. on batch nodes) '''
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+class CPUBudget:
+    '''
+        A fixed number of cores, split between outer workers (e.g., folds or experiment tasks)
+        and the threads each worker may use for trials, BLAS/OpenMP and estimators - so nested
+        parallelism never asks for more cores than there are
+    '''
+    def __init__(self, n_cpus=None):
+        self.n_cpus = n_cpus or available_cpus()
+
+    def split(self, n_tasks, n_jobs=-1):
+        '''
+            Args:
+                n_tasks: Number of independent tasks to run
+                n_jobs: Requested number of workers, joblib-style (-1 for all cores, -2 for all but one, ...)
+
+            Returns:
+                A tuple of (number of workers, threads per worker)
+        '''
+        if n_jobs is None:
+            n_jobs = 1
+        elif n_jobs < 0:
+            n_jobs = self.n_cpus + 1 + n_jobs
+
+        n_workers = max(1, min(n_tasks, n_jobs, self.n_cpus))
+        return n_workers, max(1, self.n_cpus // n_workers)
+
+    def __repr__(self):
+        return f'CPU budget: {self.n_cpus} cores'
+
+_budget = CPUBudget()
+
+# Threads the current process may use - set while running as a budgeted worker
+_threads = None
+
+# Module settings copied into every worker: name -> (getter, setter, split), see share_with_workers
+_shared_settings = {}
+
+def set_cpu_budget(n_cpus=None):
+    ''' Set the number of cores all parallel steps share (defaults to every available core) '''
+    global _budget
+    _budget = CPUBudget(n_cpus)
+    return _budget
+
+def get_cpu_budget():
+    return _budget
+
+def thread_budget():
+    ''' Number of threads the current process may use '''
+    return _threads or _budget.n_cpus
+
+@contextmanager
+def limit_threads(n_threads):
+    ''' Cap BLAS and OpenMP thread pools (and thread_budget) at n_threads for the duration '''
+    global _threads
+    previous = _threads
+    _threads = n_threads
+    try:
+        with threadpool_limits(limits=n_threads):
+            yield
+    finally:
+        _threads = previous
+
+def share_with_workers(name, getter, setter, split=None):
+    '''
+        Have a module setting (e.g., a cache configuration) follow tasks into worker processes
+
+        Args:
+            name: Name of the setting
+            getter: Module-level function returning the setting, as a tuple of setter arguments
+            setter: Module-level function applying the setting, called in the worker before each task
+            split (optional): Function taking the setting and the number of workers, and returning
+                each worker's share of it (e.g., of a memory limit) - by default, every worker
+                gets the setting unchanged
+    '''
+    _shared_settings[name] = (getter, setter, split)
+
+def worker_settings(n_workers):
+    ''' The shared settings as (setter, arguments) pairs, with each worker's share for n_workers workers '''
+    return [(setter, split(getter(), n_workers) if split else getter())
+            for getter, setter, split in _shared_settings.values()]
+
+def _run_budgeted(func, n_threads, settings, args):
+    ''' Run a task in a worker, with the parent's settings and the worker's share of the cores as its whole budget '''
+    for setter, values in settings:
+        setter(*values)
+
+    with limit_threads(n_threads):
+        return func(*args)
+
+def iter_parallel(func, tasks, n_jobs=-1):
+    '''
+        Run func over a list of argument tuples on a worker pool sized by the CPU budget, and
+        yield each result as soon as its task is done - so callers can save results (and free
+        them) while the rest are still running
+
+        Each worker gets an equal share of the cores: loky starts it with OMP_NUM_THREADS (etc.)
+        set to that share, and its BLAS/OpenMP pools and thread_budget() are capped at it too - so
+        nested calls (e.g., folds within a task) split the worker's share, not the whole machine.
+        With a single worker, tasks run in this process, in order, and a task's exception is
+        raised right away - as when calling func directly.
+
+        Args:
+            func: A module-level (picklable) function
+            tasks: List of tuples of positional arguments for func
+            n_jobs: Requested number of workers, joblib-style
+
+        Returns:
+            A generator of (task index, result, exception) tuples, in completion order - the
+            exception is None if the task succeeded, and the result is None if it failed (only
+            on a worker pool, see above)
+    '''
+    tasks = list(tasks)
+    # Inside a worker, only its own share of the cores can be split further
+    n_workers, n_threads = CPUBudget(thread_budget()).split(len(tasks), n_jobs)
+
+    if n_workers == 1:
+        for i, args in enumerate(tasks):
+            yield i, func(*args), None
+        return
+
+    print('Running %d tasks on %d workers with %d threads each.' % (len(tasks), n_workers, n_threads))
+    executor = get_reusable_executor(max_workers=n_workers, env={var: str(n_threads) for var in THREAD_VARS})
+    settings = worker_settings(n_workers)
+    futures = {executor.submit(_run_budgeted, func, n_threads, settings, args): i for i, args in enumerate(tasks)}
+
+    for future in as_completed(futures):
+        error = future.exception()
+        yield futures[future], (future.result() if error is None else None), error
+
+def run_parallel(func, tasks, n_jobs=-1):
+    '''
+        Run func over a list of argument tuples on a worker pool sized by the CPU budget (see iter_parallel)
+
+        Returns:
+            A list of func's results, in task order. The first failed task's exception is raised.
+    '''
+    tasks = list(tasks)
+    results = [None] * len(tasks)
+
+    for i, res, error in iter_parallel(func, tasks, n_jobs):
+        if error is not None:
+            raise error
+        results[i] = res
+    return results
@@ -0,0 +1,50 @@
+import collections
+import hashlib
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import StratifiedGroupKFold
+
+# Number of split sets kept in memory - one per (groups, labels, seed, n_splits)
+SPLIT_CACHE_SIZE = 64
+_split_cache = collections.OrderedDict()
+
+def clear_split_cache():
+    _split_cache.clear()
+
+def split_key(y, groups, random_state, n_splits):
+    ''' Content hash of everything the splits depend on '''
+    h = hashlib.sha1()
+    for values in [y, groups]:
+        h.update(pd.util.hash_pandas_object(pd.Series(np.asarray(values)), index=False).to_numpy().tobytes())
+    h.update(repr((random_state, n_splits)).encode())
+    return h.hexdigest()
+
+def get_splits(y, groups, random_state, n_splits=5):
+    '''
+        Subject-level stratified K-fold splits (StratifiedGroupKFold, shuffled), computed once per
+        (groups, labels, seed, n_splits) and then reused - so every method, run and depth in a sweep
+        sees identical folds without recomputing them
+
+        Args:
+            y: Labels
+            groups: Group (participant id) of each row
+            random_state: Seed of the shuffle
+            n_splits: Number of folds
+
+        Returns:
+            A list of (train indices, test indices) int32 array pairs - usable as a cv argument
+    '''
+    key = split_key(y, groups, random_state, n_splits)
+
+    if key in _split_cache:
+        _split_cache.move_to_end(key)
+    else:
+        cv = StratifiedGroupKFold(n_splits=n_splits, shuffle=True, random_state=random_state)
+        y = np.asarray(y)
+        _split_cache[key] = [(train_idx.astype(np.int32), test_idx.astype(np.int32))
+                             for train_idx, test_idx in cv.split(np.zeros(len(y)), y, groups=np.asarray(groups))]
+
+        if len(_split_cache) > SPLIT_CACHE_SIZE:
+            _split_cache.popitem(last=False)
+
+    return _split_cache[key]
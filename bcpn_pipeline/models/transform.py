@@ -1,6 +1,17 @@
 import pandas as pd
 import numpy as np
 
+def densify(df):
+    ''' Convert any sparse columns (e.g., from one_hot_encode(encoding='sparse')) back to dense ones '''
+    sparse_cols = [col for col, dtype in df.dtypes.items() if isinstance(dtype, pd.SparseDtype)]
+    if not sparse_cols:
+        return df
+
+    df = df.copy()
+    for col in sparse_cols:
+        df[col] = df[col].sparse.to_dense()
+    return df
+
 def impute(df, imputer):
     print('Imputing missing data.')
      